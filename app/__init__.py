@@ -6,6 +6,9 @@ from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_mail import Mail
 from flask_pagedown import PageDown
+from .compress import Compress
+from .rate_limit import RateLimiter
+from .fragment_cache import FragmentCacheExtension
 
 db = SQLAlchemy()
 lm = LoginManager()
@@ -13,6 +16,8 @@ bootstrap = Bootstrap()
 moment = Moment()
 mail = Mail()
 pagedown = PageDown()
+compress = Compress()
+rate_limiter = RateLimiter()
 
 lm.session_protection = "strong"
 lm.login_view = "auth.login"    # 登录端点
@@ -29,6 +34,11 @@ def create_app(config_name):
     moment.init_app(app)
     mail.init_app(app)
     pagedown.init_app(app)
+    compress.init_app(app)
+    # 限流的 before_request 必须在注册蓝本之前注册，保证它在认证、ping 等访问数据库的钩子之前执行。
+    rate_limiter.init_app(app)
+    # 模板中可以使用 {% cache key, ttl %} 缓存渲染好的片段。
+    app.jinja_env.add_extension(FragmentCacheExtension)
 
     # 注册蓝图
     from .main import main as blueprint_main
@@ -37,7 +47,10 @@ def create_app(config_name):
     from .auth import auth as blueprint_auth
     app.register_blueprint(blueprint_auth, url_prefix="/auth")
 
+    # API 蓝本的 jsonify() 使用可切换的快速 JSON 编码器，日期时间编码为 ISO 8601。
     from .api_1_0 import api as blueprint_api_1_0
+    from .json_encoder import JSONEncoder
+    blueprint_api_1_0.json_encoder = JSONEncoder
     app.register_blueprint(blueprint_api_1_0, url_prefix="/api/v1.0")
 
     return app
@@ -1,6 +1,9 @@
-from flask import g, jsonify
+import hmac
+import hashlib
+from flask import g, jsonify, current_app
 from flask_httpauth import HTTPBasicAuth
 from ..models import User, AnonymousUser
+from ..cache import app_cache
 from . import api
 from .errors import unauthorized, forbidden
 
@@ -8,6 +11,33 @@ from .errors import unauthorized, forbidden
 auth = HTTPBasicAuth()
 
 
+def credential_cache():
+    return app_cache("credentials",
+                     maxsize=current_app.config["FLASKY_CREDENTIAL_CACHE_SIZE"],
+                     ttl=current_app.config["FLASKY_CREDENTIAL_CACHE_TTL"])
+
+
+# 缓存键是 (email, 密码, 密码散列值) 的 HMAC，缓存中不保存明文密码。
+# 密码散列值和 email 都参与计算，因此修改密码、重置密码或修改 email 之后，旧的缓存条目再也不会命中。
+def credential_key(user, password):
+    message = "\0".join([user.email, password, user.password_hash])
+    return hmac.new(current_app.config["SECRET_KEY"].encode("utf-8"),
+                    message.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+# check_password_hash() 故意设计得很慢（PBKDF2），
+# 因此把验证成功的结果缓存一小段时间，持续使用 Basic 认证的客户端不必每个请求都重新计算。
+def check_credentials(user, password):
+    cache = credential_cache()
+    key = credential_key(user, password)
+    if cache.get(key):
+        return True
+    if not user.verify_password(password):
+        return False
+    cache.set(key, True)
+    return True
+
+
 # Flask-HTTPAuth 不对验证用户密令所需的步骤做任何假设，因此所需的信息在回调函数中提供。
 @auth.verify_password
 def verify_password(email_or_token, password):
@@ -24,7 +54,7 @@ def verify_password(email_or_token, password):
         return False
     g.current_user = user
     g.token_used = False
-    return user.verify_password(password)
+    return check_credentials(user, password)
 
 
 # 如果认证密令不正确，服务器向客户端返回 401 错误。
@@ -0,0 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor
+from flask import request, current_app, jsonify, g
+from . import api
+from .. import rate_limiter
+from ..exceptions import ValidationError
+
+
+# [POST], 批量执行多个 GET 请求
+# 请求主体形如 {"requests": ["/posts/1", "/users/2", ...], "concurrent": true}，
+# 路径相对于 API 的根地址（也可以写成完整的 /api/v1.0/... 路径）。
+# 整个批次只在 before_request 中认证一次（但限流按子请求计数），各个子请求直接调用对应的视图函数，
+# 响应中按请求顺序给出每个子请求的状态码和 JSON 主体。
+@api.route("/batch", methods=["POST"])
+def batch():
+    json_batch = request.json
+    paths = json_batch.get("requests") if isinstance(json_batch, dict) else None
+    if not isinstance(paths, list) or \
+            not all(isinstance(path, str) for path in paths):
+        raise ValidationError("batch must contain a list of request paths")
+    max_requests = current_app.config["FLASKY_BATCH_MAX_REQUESTS"]
+    if len(paths) > max_requests:
+        raise ValidationError("at most %d requests per batch" % max_requests)
+    # 批量请求本身只占一个写令牌，其中的每个子请求再各占一个读令牌，读配额不够时整批拒绝。
+    limited = rate_limiter.limit("read", len(paths))
+    if limited is not None:
+        return limited
+    prefix = request.path.rsplit("/", 1)[0]
+    paths = [path if path.startswith(prefix + "/") else prefix + "/" + path.lstrip("/")
+             for path in paths]
+    base_url = request.url_root
+    workers = current_app.config["FLASKY_BATCH_WORKERS"]
+    if json_batch.get("concurrent") and workers > 1 and len(paths) > 1:
+        app = current_app._get_current_object()
+        user, token_used = g.current_user, g.get("token_used")
+        with ThreadPoolExecutor(min(workers, len(paths))) as executor:
+            results = list(executor.map(
+                lambda path: dispatch_in_thread(app, user, token_used, path, base_url), paths))
+    else:
+        results = [dispatch(path, base_url) for path in paths]
+    return jsonify({"responses": results})
+
+
+# 在当前程序上下文中执行一个子请求。
+# 子请求共用批量请求的 g（因此也共用已经认证的 g.current_user），但不再执行 before_request。
+def dispatch(path, base_url):
+    with current_app.test_request_context(path, method="GET",
+                                          base_url=base_url,
+                                          headers={"Accept": "application/json"}):
+        try:
+            response = current_app.make_response(dispatch_view(path))
+        finally:
+            # 子请求设置的 ETag 不能留在共用的 g 上，否则会出现在整个批量响应中。
+            g.pop("etag", None)
+        return {"path": path,
+                "status": response.status_code,
+                "body": response.get_json(silent=True)}
+
+
+def dispatch_view(path):
+    try:
+        if request.routing_exception is not None:
+            raise request.routing_exception
+        if request.blueprint != "api" or request.endpoint == "api.batch":
+            raise ValidationError("only API GET requests can be batched")
+        return current_app.view_functions[request.endpoint](**request.view_args)
+    except Exception as e:
+        try:
+            # 与正常请求一样交给错误处理程序，例如 404 和 ValidationError。
+            return current_app.handle_user_exception(e)
+        except Exception:
+            current_app.logger.exception("Batched request %s failed" % path)
+            return jsonify({"error": "internal server error"}), 500
+
+
+# 并发执行时，每个线程使用独立的程序上下文（和数据库会话），只复制认证结果。
+def dispatch_in_thread(app, user, token_used, path, base_url):
+    with app.app_context():
+        g.current_user = user
+        g.token_used = token_used
+        return dispatch(path, base_url)
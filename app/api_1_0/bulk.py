@@ -0,0 +1,35 @@
+from flask import request, current_app, url_for
+from ..exceptions import ValidationError
+
+
+# 校验批量请求的主体：必须是不超过 FLASKY_BULK_MAX_ITEMS 个对象的数组。
+# 逐项调用 from_json()，返回 (通过校验的对象, 逐项结果)；未通过的项在结果中记为 400，
+# 通过的项留空，写入后由 bulk_results() 填上新资源的地址。
+def parse_bulk(from_json):
+    items = request.json
+    if not isinstance(items, list):
+        raise ValidationError("request body must be an array")
+    max_items = current_app.config["FLASKY_BULK_MAX_ITEMS"]
+    if len(items) > max_items:
+        raise ValidationError("at most %d items per request" % max_items)
+    objects = []
+    results = []
+    for item in items:
+        try:
+            if not isinstance(item, dict):
+                raise ValidationError("item must be an object")
+            objects.append(from_json(item))
+            results.append(None)
+        except ValidationError as e:
+            results.append({"status": 400, "error": "bad request", "message": e.args[0]})
+    return objects, results
+
+
+def bulk_results(results, ids, endpoint):
+    ids = iter(ids)
+    for i, result in enumerate(results):
+        if result is None:
+            results[i] = {"status": 201,
+                          "url": url_for(endpoint, id=next(ids), _external=True)}
+    return {"results": results,
+            "created": sum(1 for result in results if result["status"] == 201)}
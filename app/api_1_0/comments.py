@@ -1,6 +1,13 @@
 from flask import request, current_app, url_for, jsonify, g
 from . import api
 from .decorators import permission_required
+from .pagination import CursorPagination
+from .conditional import conditional_response, collection_validators, make_etag
+from .export import export
+from .fields import requested_fields
+from ..serializers import compiled_serializer
+from .bulk import parse_bulk, bulk_results
+from ..pagination import paginate
 from .. import db
 from ..models import Permission, Post, Comment
 
@@ -8,9 +15,25 @@ from ..models import Permission, Post, Comment
 # [GET], 所有评论
 @api.route("/comments/")
 def get_comments():
+    fields = requested_fields(Comment)
+    response = conditional_response(collection_validators(Comment.query, Comment))
+    if response is not None:
+        return response
+    cursor = request.args.get("cursor")
+    if cursor is not None:
+        pagination = CursorPagination(Comment.query, Comment, cursor,
+                                      current_app.config["FLASKY_COMMENTS_PER_PAGE"])
+        return jsonify({
+            "comments": list(map(compiled_serializer(Comment, fields), pagination.items)),
+            "prev": None,
+            "next": pagination.next_url("api.get_comments"),
+            "next_cursor": pagination.next_cursor,
+            "count": None
+        })
     page = request.args.get("page", 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"],
+    pagination = paginate(
+        Comment.query.order_by(Comment.timestamp.desc()), page,
+        per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"],
         error_out=False
     )
     comments = pagination.items
@@ -21,27 +44,55 @@ def get_comments():
     if pagination.has_next:
         next = url_for("api.get_comments", page=page+1, _external=True)
     return jsonify({
-        "comments": [comment.to_json() for comment in comments],
+        "comments": list(map(compiled_serializer(Comment, fields), comments)),
         "prev": prev,
         "next": next,
-        "count": pagination.total
+        "count": pagination.total,
+        "count_approximate": pagination.approximate
     })
 
 
+# [GET], 导出所有评论（NDJSON）
+@api.route("/comments/export")
+def export_comments():
+    return export(Comment.query, Comment, Comment.timestamp)
+
+
 # [GET], 一篇评论
 @api.route("/comments/<int:id>")
 def get_comment(id):
+    fields = requested_fields(Comment)
     comment = Comment.query.get_or_404(id)
-    return jsonify(comment.to_json())
+    response = conditional_response(make_etag(comment.id, comment.version))
+    if response is not None:
+        return response
+    return jsonify(comment.to_json(fields))
 
 
 # [GET], 一篇博客文章中的评论
 @api.route("/posts/<int:id>/comments/")
 def get_post_comments(id):
+    fields = requested_fields(Comment)
     post = Post.query.get_or_404(id)
+    response = conditional_response(collection_validators(post.comments, Comment))
+    if response is not None:
+        return response
+    cursor = request.args.get("cursor")
+    if cursor is not None:
+        pagination = CursorPagination(post.comments, Comment, cursor,
+                                      current_app.config["FLASKY_COMMENTS_PER_PAGE"],
+                                      ascending=True)
+        return jsonify({
+            "comments": list(map(compiled_serializer(Comment, fields), pagination.items)),
+            "prev": None,
+            "next": pagination.next_url("api.get_post_comments", id=id),
+            "next_cursor": pagination.next_cursor,
+            "count": None
+        })
     page = request.args.get("page", 1, type=int)
-    pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
-        page, per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"],
+    pagination = paginate(
+        post.comments.order_by(Comment.timestamp.asc()), page,
+        per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"],
         error_out=False)
     comments = pagination.items
     prev = None
@@ -51,10 +102,11 @@ def get_post_comments(id):
     if pagination.has_next:
         next = url_for("api.get_post_comments", id=id, page=page+1, _external=True)
     return jsonify({
-        "comments": [comment.to_json() for comment in comments],
+        "comments": list(map(compiled_serializer(Comment, fields), comments)),
         "prev": prev,
         "next": next,
-        "count": pagination.total
+        "count": pagination.total,
+        "count_approximate": pagination.approximate
     })
 
 
@@ -64,9 +116,20 @@ def get_post_comments(id):
 def new_post_comment(id):
     post = Post.query.get_or_404(id)
     comment = Comment.from_json(request.json)
-    comment.author = g.current_user
+    comment.author_id = g.current_user.id
     comment.post = post
     db.session.add(comment)
     db.session.commit()
     return jsonify(comment.to_json()), 201, \
            {"Location": url_for("api.get_comments", id=comment.id, _external=True)}
+
+
+# [POST], 批量创建一篇博客文章中的评论
+@api.route("/posts/<int:id>/comments/bulk", methods=["POST"])
+@permission_required(Permission.COMMENT)
+def new_post_comments(id):
+    post = Post.query.get_or_404(id)
+    comments, results = parse_bulk(Comment.from_json)
+    ids = Comment.bulk_create(g.current_user.id, post.id, comments)
+    db.session.commit()
+    return jsonify(bulk_results(results, ids, "api.get_comment"))
@@ -0,0 +1,42 @@
+import hashlib
+from flask import request, current_app, g
+from . import api
+from .. import db
+
+
+# 由若干版本信息和请求的完整 URL（包含主机名、页码、游标等参数）生成强 ETag。
+# 响应中的链接都是带主机名的绝对地址，因此 URL 不同时即使数据相同也要使用不同的 ETag。
+def make_etag(*parts):
+    data = "\0".join(str(part) for part in parts + (request.url,))
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+# 集合的版本信息用一条聚合查询得到：最新时间戳、最大 id、记录数和行版本号之和。
+# 新增、删除记录会改变前三项，编辑记录会改变版本号之和；
+# sums 中的其他列（例如文章的 comment_count）也会出现在响应里，一并求和。
+def collection_validators(query, model, *sums):
+    columns = [db.func.max(model.timestamp), db.func.max(model.id),
+               db.func.count(model.id), db.func.sum(model.version)]
+    columns.extend(db.func.sum(column) for column in sums)
+    row = query.order_by(None).with_entities(*columns).one()
+    return make_etag(*row)
+
+
+# 校验 If-None-Match，条件满足时返回 304 响应，否则返回 None。
+# 调用方应在序列化之前调用，命中时直接返回，不再生成 JSON。
+#
+# 只使用 ETag，不发送 Last-Modified：文章和评论的 timestamp 是创建时间，编辑、新增评论、
+# 管理员修改资料都不会改变任何时间列，按 If-Modified-Since 判断会把旧内容当作未修改返回 304。
+def conditional_response(etag):
+    g.etag = etag
+    if request.if_none_match and request.if_none_match.contains_weak(etag):
+        return current_app.response_class(status=304)
+    return None
+
+
+@api.after_request
+def set_validators(response):
+    etag = g.get("etag")
+    if etag is not None and response.status_code in (200, 304):
+        response.set_etag(etag)
+    return response
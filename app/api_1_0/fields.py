@@ -0,0 +1,15 @@
+from flask import request
+from ..exceptions import ValidationError
+
+
+# 解析 ?fields=body,timestamp 形式的稀疏字段集，未指定时返回 None（输出全部字段）。
+# 字段名必须出现在 model.json_fields 中，否则视为错误请求。
+def requested_fields(model):
+    value = request.args.get("fields")
+    if value is None:
+        return None
+    fields = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = set(fields) - set(model.json_fields)
+    if unknown:
+        raise ValidationError("unknown fields: %s" % ", ".join(sorted(unknown)))
+    return fields
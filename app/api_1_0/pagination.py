@@ -0,0 +1,47 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from flask import url_for
+from ..exceptions import ValidationError
+
+
+def encode_cursor(item):
+    key = "%s|%d" % (item.timestamp.strftime("%Y-%m-%dT%H:%M:%S.%f"), item.id)
+    return urlsafe_b64encode(key.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, id = urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+        return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%f"), int(id)
+    except (ValueError, TypeError, UnicodeError):
+        raise ValidationError("invalid cursor")
+
+
+# 游标（keyset）分页。
+# 以 (timestamp, id) 作为排序键，用"上一页最后一条记录之后"的条件直接定位，
+# 不需要 OFFSET 跳过前面的行，也不需要 COUNT(*) 统计总数，因此翻到多深的页都一样快。
+# 空游标（?cursor=）表示以游标模式请求第一页。
+class CursorPagination:
+    def __init__(self, query, model, cursor, per_page, ascending=False):
+        if ascending:
+            query = query.order_by(model.timestamp.asc(), model.id.asc())
+        else:
+            query = query.order_by(model.timestamp.desc(), model.id.desc())
+        if cursor:
+            timestamp, id = decode_cursor(cursor)
+            if ascending:
+                query = query.filter((model.timestamp > timestamp) |
+                                     ((model.timestamp == timestamp) & (model.id > id)))
+            else:
+                query = query.filter((model.timestamp < timestamp) |
+                                     ((model.timestamp == timestamp) & (model.id < id)))
+        # 多取一条，用来判断是否还有下一页。
+        items = query.limit(per_page + 1).all()
+        self.has_next = len(items) > per_page
+        self.items = items[:per_page]
+        self.next_cursor = encode_cursor(self.items[-1]) if self.has_next else None
+
+    def next_url(self, endpoint, **kwargs):
+        if not self.has_next:
+            return None
+        return url_for(endpoint, cursor=self.next_cursor, _external=True, **kwargs)
@@ -4,13 +4,35 @@ from .. import db
 from ..models import Permission, Post
 from .errors import forbidden
 from .decorators import permission_required
+from .pagination import CursorPagination
+from .conditional import conditional_response, collection_validators, make_etag
+from .export import export
+from .fields import requested_fields
+from ..serializers import compiled_serializer
+from .bulk import parse_bulk, bulk_results
+from ..pagination import paginate
 
 # [GET], 所有博客文章
 @api.route("/posts/")
 def get_posts():
+    fields = requested_fields(Post)
+    response = conditional_response(collection_validators(Post.query, Post, Post.comment_count))
+    if response is not None:
+        return response
+    cursor = request.args.get("cursor")
+    if cursor is not None:
+        pagination = CursorPagination(Post.query, Post, cursor,
+                                      current_app.config["FLASKY_POSTS_PER_PAGE"])
+        return jsonify({
+            "posts": list(map(compiled_serializer(Post, fields), pagination.items)),
+            "prev": None,
+            "next": pagination.next_url("api.get_posts"),
+            "next_cursor": pagination.next_cursor,
+            "count": None
+        })
     page = request.args.get("page", 1, type=int)
-    pagination = Post.query.paginate(
-        page=page,
+    pagination = paginate(
+        Post.query, page,
         per_page=current_app.config["FLASKY_POSTS_PER_PAGE"],
         error_out=False)
     posts = pagination.items
@@ -21,18 +43,30 @@ def get_posts():
     if pagination.has_next:
         next = url_for("api.get_posts", page=page+1, _external=True)
     return jsonify({
-        "posts": [post.to_json() for post in posts],
+        "posts": list(map(compiled_serializer(Post, fields), posts)),
         "prev": prev,
         "next": next,
-        "count": pagination.total
+        "count": pagination.total,
+        "count_approximate": pagination.approximate
     })
 
 
+# [GET], 导出所有博客文章（NDJSON）
+@api.route("/posts/export")
+def export_posts():
+    return export(Post.query, Post, Post.timestamp)
+
+
 # [GET], 一篇博客文章
 @api.route("/posts/<int:id>")
 def get_post(id):
+    fields = requested_fields(Post)
     post = Post.query.get_or_404(id)
-    return jsonify(post.to_json())
+    # 评论数也在响应中，但新增评论不经过 ORM 更新文章，不会改变版本号，因此一并计入 ETag。
+    response = conditional_response(make_etag(post.id, post.version, post.comment_count))
+    if response is not None:
+        return response
+    return jsonify(post.to_json(fields))
 
 
 # [POST], 所有博客文章
@@ -40,7 +74,8 @@ def get_post(id):
 @permission_required(Permission.WRITE_ARTICLES)
 def new_post():
     post = Post.from_json(request.json)
-    post.author = g.current_user
+    # 只设置外键，令牌认证时 g.current_user 不是完整的 User 对象，也不必为此加载用户。
+    post.author_id = g.current_user.id
     db.session.add(post)
     db.session.commit()
     # 为便于客户端操作，响应的主体中包含了新建的资源。
@@ -49,12 +84,24 @@ def new_post():
            {"Location": url_for("api.get_post", id=post.id, _external=True)}
 
 
+# [POST], 批量创建博客文章
+# 每项的格式与 new_post 相同，全部有效的文章在一个事务中批量写入（见 Post.bulk_create），
+# 响应中按请求顺序给出每一项的状态。
+@api.route("/posts/bulk", methods=["POST"])
+@permission_required(Permission.WRITE_ARTICLES)
+def new_posts():
+    posts, results = parse_bulk(Post.from_json)
+    ids = Post.bulk_create(g.current_user.id, posts)
+    db.session.commit()
+    return jsonify(bulk_results(results, ids, "api.get_post"))
+
+
 # [PUT], 一篇博客文章
 @api.route("/posts/<int:id>", methods=["PUT"])
 @permission_required(Permission.WRITE_ARTICLES)
 def edit_post(id):
     post = Post.query.get_or_404(id)
-    if g.current_user != post.author or \
+    if g.current_user.id != post.author_id and \
             not g.current_user.is_administrator():
         return forbidden("Insufficient permissions")
     post.body = request.json.get("body", post.body)
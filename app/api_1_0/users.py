@@ -1,22 +1,55 @@
 from flask import request, current_app, url_for, jsonify, g
 from . import api
 from ..models import User, Post
+from .pagination import CursorPagination
+from .conditional import conditional_response, collection_validators, make_etag
+from .export import export
+from .fields import requested_fields
+from ..serializers import compiled_serializer
+from ..pagination import paginate
 
 
 # [GET], 一个用户
 @api.route("/users/<int:id>")
 def get_user(id):
+    fields = requested_fields(User)
     user = User.query.get_or_404(id)
-    return jsonify(user.to_json())
+    response = conditional_response(
+        make_etag(user.id, user.username, user.member_since, user.last_seen, user.post_count))
+    if response is not None:
+        return response
+    return jsonify(user.to_json(fields))
+
+
+# [GET], 导出所有用户（NDJSON），时间过滤按注册时间
+@api.route("/users/export")
+def export_users():
+    return export(User.query, User, User.member_since)
 
 
 # [GET], 一个用户发布的博客文章
 @api.route("/users/<int:id>/posts/")
 def get_user_posts(id):
+    fields = requested_fields(Post)
     user = User.query.get_or_404(id)
+    response = conditional_response(collection_validators(user.posts, Post, Post.comment_count))
+    if response is not None:
+        return response
+    cursor = request.args.get("cursor")
+    if cursor is not None:
+        pagination = CursorPagination(user.posts, Post, cursor,
+                                      current_app.config["FLASKY_POSTS_PER_PAGE"])
+        return jsonify({
+            "posts": list(map(compiled_serializer(Post, fields), pagination.items)),
+            "prev": None,
+            "next": pagination.next_url("api.get_user_posts", id=id),
+            "next_cursor": pagination.next_cursor,
+            "count": None
+        })
     page = request.args.get("page", 1, type=int)
-    pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config["FLASKY_POSTS_PER_PAGE"],
+    pagination = paginate(
+        user.posts.order_by(Post.timestamp.desc()), page,
+        per_page=current_app.config["FLASKY_POSTS_PER_PAGE"],
         error_out=False)
     posts = pagination.items
     prev = None
@@ -26,20 +59,37 @@ def get_user_posts(id):
     if pagination.has_next:
         next = url_for("api.get_user_posts", id=id, page=page+1, _external=True)
     return jsonify({
-        "posts": [post.to_json() for post in posts],
+        "posts": list(map(compiled_serializer(Post, fields), posts)),
         "prev": prev,
         "next": next,
-        "count": pagination.total
+        "count": pagination.total,
+        "count_approximate": pagination.approximate
     })
 
 
 # [GET], 一个用户所关注用户发布的文章
 @api.route("/users/<int:id>/timeline/")
 def get_user_followed_posts(id):
+    fields = requested_fields(Post)
     user = User.query.get_or_404(id)
+    response = conditional_response(collection_validators(user.followed_posts, Post, Post.comment_count))
+    if response is not None:
+        return response
+    cursor = request.args.get("cursor")
+    if cursor is not None:
+        pagination = CursorPagination(user.followed_posts, Post, cursor,
+                                      current_app.config["FLASKY_POSTS_PER_PAGE"])
+        return jsonify({
+            "posts": list(map(compiled_serializer(Post, fields), pagination.items)),
+            "prev": None,
+            "next": pagination.next_url("api.get_user_followed_posts", id=id),
+            "next_cursor": pagination.next_cursor,
+            "count": None
+        })
     page = request.args.get("page", 1, type=int)
-    pagination = user.followed_posts.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config["FLASKY_POSTS_PER_PAGE"],
+    pagination = paginate(
+        user.followed_posts.order_by(Post.timestamp.desc()), page,
+        per_page=current_app.config["FLASKY_POSTS_PER_PAGE"],
         error_out=False)
     posts = pagination.items
     prev = None
@@ -49,8 +99,26 @@ def get_user_followed_posts(id):
     if pagination.has_next:
         next = url_for("api.get_user_followed_posts", id=id, page=page+1, _external=True)
     return jsonify({
-        "posts": [post.to_json() for post in posts],
+        "posts": list(map(compiled_serializer(Post, fields), posts)),
         "prev": prev,
         "next": next,
-        "count": pagination.total
+        "count": pagination.total,
+        "count_approximate": pagination.approximate
+    })
+
+
+# [GET], 推荐一个用户关注的用户
+@api.route("/users/<int:id>/suggestions/")
+def get_user_suggestions(id):
+    fields = requested_fields(User)
+    user = User.query.get_or_404(id)
+    suggestions = user.suggestions()
+    serialize = compiled_serializer(User, fields)
+    return jsonify({
+        "suggestions": [{
+            "user": serialize(suggestion.suggested),
+            "mutual_count": suggestion.mutual_count,
+            "score": suggestion.score
+        } for suggestion in suggestions],
+        "count": len(suggestions)
     })
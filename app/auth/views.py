@@ -1,4 +1,5 @@
-from flask import request, render_template, redirect, url_for, flash
+from datetime import datetime
+from flask import request, render_template, redirect, url_for, flash, current_app
 from flask_login import login_user, logout_user, login_required, current_user
 from . import auth
 from .forms import LoginForm, RegistrationForm, ChangePasswordFrom, \
@@ -15,7 +16,11 @@ from ..models import User
 def before_request():
     if current_user.is_authenticated:
         # 每次收到用户的请求时都要调用 ping() 方法，刷新用户的最后访问时间。
-        current_user.ping()
+        # 同一用户在 FLASKY_LAST_SEEN_MIN_INTERVAL 秒内只刷新一次。
+        last_seen = current_user.last_seen
+        if last_seen is None or (datetime.utcnow() - last_seen).total_seconds() >= \
+                current_app.config["FLASKY_LAST_SEEN_MIN_INTERVAL"]:
+            current_user.ping()
         if not current_user.confirmed \
                 and request.endpoint \
                 and request.endpoint[:5] != "auth." \
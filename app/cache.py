@@ -0,0 +1,76 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from flask import current_app
+
+
+# 进程内的 LRU + TTL 缓存。
+# maxsize 限制条目数，超出时淘汰最久未使用的条目；ttl 为 None 表示条目不过期。
+# 所有操作都加锁，可以在多线程的 WSGI 服务器中共享。
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+    def __len__(self):
+        return len(self._data)
+
+
+# 每个程序实例各自持有一组命名缓存，保存在 app.extensions 中，
+# 这样测试中创建的多个程序实例之间不会互相污染。
+def app_cache(name, maxsize, ttl=None):
+    caches = current_app.extensions.setdefault("flasky_caches", {})
+    cache = caches.get(name)
+    if cache is None:
+        cache = caches.setdefault(name, TTLCache(maxsize=maxsize, ttl=ttl))
+    return cache
+
+
+def cache_stats():
+    caches = current_app.extensions.get("flasky_caches", {})
+    return dict((name, cache.stats()) for name, cache in caches.items())
@@ -0,0 +1,122 @@
+import time
+import zlib
+from flask import request, current_app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# 按服务器的偏好排列，客户端给出的权重相同时选择靠前的编码。
+def supported_encodings():
+    if brotli is not None:
+        return ["br", "gzip", "deflate"]
+    return ["gzip", "deflate"]
+
+
+class _ZlibCompressor:
+    def __init__(self, encoding, level):
+        # gzip 使用带 gzip 头的格式（wbits + 16），HTTP 的 deflate 指的是 zlib 格式。
+        wbits = zlib.MAX_WBITS | 16 if encoding == "gzip" else zlib.MAX_WBITS
+        self._compressobj = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        return self._compressobj.compress(data)
+
+    def flush(self):
+        return self._compressobj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressobj.flush(zlib.Z_FINISH)
+
+
+class _BrotliCompressor:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+# 响应压缩。
+# 在 after_request 中按 Accept-Encoding 选择 br/gzip/deflate 压缩响应主体，
+# 以下情况不压缩：状态码不是 2xx（或是 204）、已经设置了 Content-Encoding、
+# MIME 类型不在 FLASKY_COMPRESS_MIMETYPES 中、主体短于 FLASKY_COMPRESS_MIN_SIZE、
+# 请求由 FLASKY_COMPRESS_EXCLUDE_BLUEPRINTS 中的蓝本处理，以及 send_file 之类的直通响应。
+#
+# 流式响应逐块压缩。同步刷新会结束当前的压缩块，每个小块（例如 NDJSON 的一行）都刷新会让压缩率大幅下降，
+# 因此自上次刷新以来累计输入 FLASKY_COMPRESS_STREAM_BUFFER 字节、或距上次刷新超过
+# FLASKY_COMPRESS_STREAM_INTERVAL 秒时才刷新一次，兼顾压缩率和客户端收到数据的及时性。
+class Compress:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.after_request(self.after_request)
+
+    def compressor(self, encoding, config):
+        if encoding == "br":
+            return _BrotliCompressor(config["FLASKY_COMPRESS_BROTLI_QUALITY"])
+        return _ZlibCompressor(encoding, config["FLASKY_COMPRESS_LEVEL"])
+
+    def should_compress(self, response, config):
+        if not config["FLASKY_COMPRESS"]:
+            return False
+        if response.status_code < 200 or response.status_code >= 300 or \
+                response.status_code == 204:
+            return False
+        if response.direct_passthrough or "Content-Encoding" in response.headers:
+            return False
+        if response.mimetype not in config["FLASKY_COMPRESS_MIMETYPES"]:
+            return False
+        return request.blueprint not in config["FLASKY_COMPRESS_EXCLUDE_BLUEPRINTS"]
+
+    def after_request(self, response):
+        config = current_app.config
+        if not self.should_compress(response, config):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = request.accept_encodings.best_match(supported_encodings())
+        if encoding is None:
+            return response
+        compressor = self.compressor(encoding, config)
+        if response.is_streamed:
+            response.response = self.stream(compressor, response.iter_encoded(),
+                                             config["FLASKY_COMPRESS_STREAM_BUFFER"],
+                                             config["FLASKY_COMPRESS_STREAM_INTERVAL"])
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < config["FLASKY_COMPRESS_MIN_SIZE"]:
+                return response
+            response.set_data(compressor.compress(data) + compressor.finish())
+        response.headers["Content-Encoding"] = encoding
+        # 压缩后的字节与原始内容不同，强 ETag 不再成立，改为弱 ETag。
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    @staticmethod
+    def stream(compressor, chunks, buffer_size, interval):
+        pending = 0
+        flushed_at = time.monotonic()
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            pending += len(chunk)
+            now = time.monotonic()
+            if pending >= buffer_size or now - flushed_at >= interval:
+                data += compressor.flush()
+                pending = 0
+                flushed_at = now
+            if data:
+                yield data
+        yield compressor.finish()
@@ -0,0 +1,115 @@
+import time
+from array import array
+from bisect import bisect_left
+from threading import Lock
+from flask import current_app
+
+
+def _contains(ids, id):
+    i = bisect_left(ids, id)
+    return i < len(ids) and ids[i] == id
+
+
+def _insert(ids, id):
+    i = bisect_left(ids, id)
+    if i == len(ids) or ids[i] != id:
+        ids.insert(i, id)
+
+
+def _remove(ids, id):
+    i = bisect_left(ids, id)
+    if i < len(ids) and ids[i] == id:
+        del ids[i]
+
+
+# 进程内的关注关系索引。
+# 每个用户对应两个有序整数数组（关注的人、关注者），成员判断用二分查找，计数直接取长度，
+# 都不需要访问数据库。
+#
+# 本进程内的 follow()/unfollow() 会直接更新索引；其他进程新增的关注关系
+# 按 Follow.timestamp 增量拉取（每 FLASKY_FOLLOW_GRAPH_REFRESH 秒一次），
+# 其他进程的取消关注则由每 FLASKY_FOLLOW_GRAPH_REBUILD 秒一次的全量重建来同步。
+class FollowGraph:
+    def __init__(self, refresh_interval, rebuild_interval):
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self._following = {}
+        self._followers = {}
+        self._watermark = None
+        self._refreshed_at = 0
+        self._rebuilt_at = 0
+        self._lock = Lock()
+
+    def rebuild(self):
+        from .models import Follow, db
+        following = {}
+        followers = {}
+        watermark = None
+        rows = db.session.query(Follow.follower_id, Follow.followed_id, Follow.timestamp).\
+            order_by(Follow.follower_id, Follow.followed_id)
+        for follower_id, followed_id, timestamp in rows:
+            following.setdefault(follower_id, array("l")).append(followed_id)
+            followers.setdefault(followed_id, []).append(follower_id)
+            if timestamp is not None and (watermark is None or timestamp > watermark):
+                watermark = timestamp
+        followers = dict((id, array("l", sorted(ids))) for id, ids in followers.items())
+        with self._lock:
+            self._following, self._followers = following, followers
+            self._watermark = watermark
+            self._refreshed_at = self._rebuilt_at = time.monotonic()
+
+    def refresh(self):
+        from .models import Follow, db
+        query = db.session.query(Follow.follower_id, Follow.followed_id, Follow.timestamp)
+        if self._watermark is not None:
+            # 用 >= 而不是 >，避免漏掉与水位线时间戳相同的记录；重复的记录插入时会被忽略。
+            query = query.filter(Follow.timestamp >= self._watermark)
+        rows = query.all()
+        with self._lock:
+            for follower_id, followed_id, timestamp in rows:
+                self._add(follower_id, followed_id)
+                if timestamp is not None and (self._watermark is None or timestamp > self._watermark):
+                    self._watermark = timestamp
+            self._refreshed_at = time.monotonic()
+
+    def sync(self):
+        now = time.monotonic()
+        if now - self._rebuilt_at >= self.rebuild_interval:
+            self.rebuild()
+        elif now - self._refreshed_at >= self.refresh_interval:
+            self.refresh()
+
+    def _add(self, follower_id, followed_id):
+        _insert(self._following.setdefault(follower_id, array("l")), followed_id)
+        _insert(self._followers.setdefault(followed_id, array("l")), follower_id)
+
+    def add(self, follower_id, followed_id):
+        with self._lock:
+            self._add(follower_id, followed_id)
+
+    def remove(self, follower_id, followed_id):
+        with self._lock:
+            _remove(self._following.get(follower_id, []), followed_id)
+            _remove(self._followers.get(followed_id, []), follower_id)
+
+    def is_following(self, follower_id, followed_id):
+        return _contains(self._following.get(follower_id, ()), followed_id)
+
+    def following_count(self, user_id):
+        return len(self._following.get(user_id, ()))
+
+    def followers_count(self, user_id):
+        return len(self._followers.get(user_id, ()))
+
+
+# 未启用 FLASKY_FOLLOW_GRAPH_INDEX 时返回 None，调用方退回到数据库查询。
+def follow_graph():
+    if not current_app.config["FLASKY_FOLLOW_GRAPH_INDEX"]:
+        return None
+    graph = current_app.extensions.get("follow_graph")
+    if graph is None:
+        graph = current_app.extensions.setdefault(
+            "follow_graph", FollowGraph(current_app.config["FLASKY_FOLLOW_GRAPH_REFRESH"],
+                                        current_app.config["FLASKY_FOLLOW_GRAPH_REBUILD"]))
+    graph.sync()
+    return graph
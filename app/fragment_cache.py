@@ -0,0 +1,40 @@
+from flask import current_app
+from jinja2 import nodes
+from jinja2.ext import Extension
+from .cache import app_cache
+
+
+# 模板片段缓存。
+# 用法：{% cache key, ttl %} ... {% endcache %}，ttl 可以省略（使用 FLASKY_FRAGMENT_CACHE_TTL）。
+# key 通常是一个元组，例如 ("post", post.id, post.version)，其中要包含片段内容依赖的所有数据：
+# 文章或评论修改后 version 加一，对应的旧片段不会再被读到，最终被 LRU 淘汰或过期。
+# 缓存的片段对所有用户相同，因此与当前用户有关的内容（编辑链接等）必须放在块外面。
+class FragmentCacheExtension(Extension):
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        # 片段的键加上模板名，不同模板中相同的键不会冲突。
+        args = [nodes.Const(parser.name), parser.parse_expression()]
+        if parser.stream.skip_if("comma"):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(["name:endcache"], drop_needle=True)
+        return nodes.CallBlock(self.call_method("_cache_support", args),
+                               [], [], body).set_lineno(lineno)
+
+    @staticmethod
+    def _cache_support(name, key, ttl, caller):
+        config = current_app.config
+        ttl = config["FLASKY_FRAGMENT_CACHE_TTL"] if ttl is None else ttl
+        if not ttl:
+            return caller()
+        key = (name,) + (tuple(key) if isinstance(key, (tuple, list)) else (key,))
+        fragments = app_cache("fragments", maxsize=config["FLASKY_FRAGMENT_CACHE_SIZE"])
+        # 开启自动转义时 caller() 返回 Markup，原样缓存，再次输出时不会被重复转义。
+        rv = fragments.get(key)
+        if rv is None:
+            rv = caller()
+            fragments.set(key, rv, ttl=ttl)
+        return rv
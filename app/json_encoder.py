@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta
+from flask import current_app, json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def iso_datetime(value):
+    # 数据库中的时间都是不带时区的 UTC 时间，输出时加上 Z 后缀。
+    if value.tzinfo is None or value.utcoffset() == timedelta(0):
+        return value.replace(tzinfo=None).isoformat() + "Z"
+    return value.isoformat()
+
+
+# API 蓝本使用的 JSON 编码器。
+# FLASKY_JSON_ENCODER 为 "auto" 时，安装了 orjson 就用它编码，否则使用标准库；
+# 也可以指定为 "orjson" 或 "stdlib"。两种实现都把 datetime 编码为 ISO 8601 格式（UTC，带 Z 后缀），
+# 输出的区别只在于 orjson 直接输出 UTF-8 字符，而标准库按 JSON_AS_ASCII 转义非 ASCII 字符。
+#
+# jsonify() 最终调用 json.dumps(cls=...)，因此这里通过覆盖 encode() 接入 orjson，
+# 缩进、键排序等选项仍由 Flask 传入。
+class JSONEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, datetime):
+            return iso_datetime(o)
+        return json.JSONEncoder.default(self, o)
+
+    def encode(self, o):
+        if use_orjson():
+            option = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+            if self.sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            if self.indent:
+                option |= orjson.OPT_INDENT_2
+            return orjson.dumps(o, default=self.default, option=option).decode("utf-8")
+        return json.JSONEncoder.encode(self, o)
+
+    def iterencode(self, o, _one_shot=False):
+        if use_orjson():
+            return iter([self.encode(o)])
+        return json.JSONEncoder.iterencode(self, o, _one_shot)
+
+
+def use_orjson():
+    encoder = current_app.config["FLASKY_JSON_ENCODER"]
+    if encoder == "orjson" and orjson is None:
+        raise RuntimeError("FLASKY_JSON_ENCODER is 'orjson' but orjson is not installed")
+    return orjson is not None and encoder in ("auto", "orjson")
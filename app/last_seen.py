@@ -0,0 +1,90 @@
+import atexit
+import time
+import weakref
+from threading import Lock
+from flask import current_app
+
+
+# last_seen 的延迟写入缓冲区。
+# 每个请求只把 (用户 id, 时间) 记在内存里，同一用户多次访问只保留最新的时间；
+# 每隔 FLASKY_LAST_SEEN_FLUSH_INTERVAL 秒用一条批量 UPDATE 写回数据库，进程退出时再写一次。
+# 这样普通的页面访问不再需要写数据库，SQLite 上的请求也不会都排队等待写锁。
+class LastSeenBuffer:
+    def __init__(self, app):
+        self.app = app
+        self.flush_interval = app.config["FLASKY_LAST_SEEN_FLUSH_INTERVAL"]
+        self._pending = {}
+        self._flushed_at = time.monotonic()
+        self._lock = Lock()
+        _buffers.add(self)
+
+    def add(self, user_id, last_seen):
+        with self._lock:
+            if last_seen > self._pending.get(user_id, last_seen.min):
+                self._pending[user_id] = last_seen
+
+    def maybe_flush(self):
+        if time.monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def _take(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed_at = time.monotonic()
+        return pending
+
+    @staticmethod
+    def _write(pending):
+        from .models import User, db, forget_cached_user
+        users = User.__table__
+        update = users.update().\
+            where(users.c.id == db.bindparam("_id")).\
+            values(last_seen=db.bindparam("_last_seen"))
+        db.engine.execute(update, [{"_id": id, "_last_seen": last_seen}
+                                   for id, last_seen in pending.items()])
+        forget_cached_user(*pending)
+
+    def flush(self):
+        pending = self._take()
+        if not pending:
+            return 0
+        try:
+            self._write(pending)
+        except Exception:
+            current_app.logger.exception("Failed to flush last_seen updates")
+            # 写入失败时放回缓冲区，下次再试。
+            for id, last_seen in pending.items():
+                self.add(id, last_seen)
+            return 0
+        return len(pending)
+
+    # 进程退出时尽力写回，失败也无法再重试，直接忽略。
+    def flush_at_exit(self):
+        pending = self._take()
+        if not pending:
+            return
+        try:
+            with self.app.app_context():
+                self._write(pending)
+        except Exception:
+            pass
+
+
+# 进程退出时写回所有仍然存在的缓冲区。
+# 只在模块加载时注册一次 atexit 处理函数，缓冲区用弱引用登记：
+# 测试等场景中反复调用 create_app() 时，处理函数不会越积越多，也不会让已经不用的程序实例一直无法回收。
+_buffers = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_all_at_exit():
+    for buffer in list(_buffers):
+        buffer.flush_at_exit()
+
+
+def last_seen_buffer():
+    buffer = current_app.extensions.get("last_seen_buffer")
+    if buffer is None:
+        buffer = current_app.extensions.setdefault(
+            "last_seen_buffer", LastSeenBuffer(current_app._get_current_object()))
+    return buffer
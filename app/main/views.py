@@ -1,4 +1,5 @@
-from flask import render_template, redirect, flash, url_for, request, current_app, abort, make_response
+from flask import render_template, redirect, flash, url_for, request, current_app, abort, make_response, \
+    jsonify
 from flask_login import login_required, current_user
 from flask_sqlalchemy import get_debug_queries
 from . import main
@@ -6,6 +7,9 @@ from .forms import EditProfileForm, EditProfileAdminForm, PostForm, CommentForm
 from .. import db
 from ..models import User, Role, Post, Comment, Permission
 from ..decorators import admin_required, permission_required
+from ..pagination import paginate
+from ..cache import cache_stats
+from ..page_cache import cached_page
 
 
 @main.after_app_request
@@ -34,7 +38,16 @@ def server_shutdown():
     return "Shutting down..."
 
 
+# 各进程内缓存的命中率等统计信息，仅管理员可见。
+@main.route("/cache-stats")
+@login_required
+@admin_required
+def server_cache_stats():
+    return jsonify(cache_stats())
+
+
 @main.route("/", methods=["GET", "POST"])
+@cached_page
 def index():
     form = PostForm()
     if current_user.can(Permission.WRITE_ARTICLES) and \
@@ -59,20 +72,22 @@ def index():
         query = Post.query
     # error_out 参数，当其设为 True 时（默认值），如果请求的页数超出了范围，则会返回404 错误；
     # 如果设为 False，页数超出范围时会返回一个空列表。
-    pagination = query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config["FLASKY_POSTS_PER_PAGE"],
+    pagination = paginate(
+        query.order_by(Post.timestamp.desc()), page,
+        per_page=current_app.config["FLASKY_POSTS_PER_PAGE"],
         error_out=False)
-    posts = pagination.items
+    posts = Post.preload(pagination.items)
     return render_template("index.html", form=form, posts=posts,
                            show_followed=show_followed,
                            pagination=pagination)
 
 
 @main.route("/user/<username>")
+@cached_page
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
     # user.posts 返回的是查询对象，因此可在其上调用过滤器。
-    posts = user.posts.order_by(Post.timestamp.desc()).all()
+    posts = Post.preload(user.posts.order_by(Post.timestamp.desc()))
     return render_template("user.html", user=user, posts=posts)
 
 
@@ -101,6 +116,9 @@ def edit_profile_admin(id):
     user = User.query.get_or_404(id)
     form = EditProfileAdminForm(user)
     if form.validate_on_submit():
+        # 角色或确认状态改变后，令牌中携带的权限信息已经过时，吊销旧令牌。
+        if user.role_id != form.role.data or user.confirmed != form.confirmed.data:
+            user.revoke_auth_tokens()
         user.email = form.email.data
         user.username = form.username.data
         user.confirmed = form.confirmed.data
@@ -123,6 +141,7 @@ def edit_profile_admin(id):
 
 
 @main.route("/post/<int:id>", methods=["GET", "POST"])
+@cached_page
 def post(id):
     post = Post.query.get_or_404(id)
     form = CommentForm()
@@ -137,15 +156,16 @@ def post(id):
         return redirect(url_for(".post", id=post.id, page=-1))
     page = request.args.get("page", 1, type=int)
     if page == -1:
-        page = (post.comments.count() - 1) // \
+        page = (post.comment_count - 1) // \
             current_app.config["FLASKY_COMMENTS_PER_PAGE"] + 1
-    pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
-        page, per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"],
+    pagination = paginate(
+        post.comments.order_by(Comment.timestamp.asc()), page,
+        per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"],
         error_out=False
     )
-    comments = pagination.items
+    comments = Comment.preload(pagination.items)
     # 注意，post.html 模板接收一个列表作为参数，这个列表就是要渲染的文章。
-    return render_template("post.html", posts=[post], form=form,
+    return render_template("post.html", posts=Post.preload([post]), form=form,
                            comments=comments, pagination=pagination)
 
 
@@ -175,10 +195,9 @@ def follow(username):
     if user is None:
         flash("Invalid user.")
         return redirect(url_for(".index"))
-    if current_user.is_following(user):
+    if not current_user.follow(user):
         flash("You are already following this user.")
         return redirect(url_for(".user", username=username))
-    current_user.follow(user)
     flash("You are now following %s." % username)
     return redirect(url_for(".user", username=username))
 
@@ -191,10 +210,9 @@ def unfollow(username):
     if user is None:
         flash("Invalid user.")
         return redirect(url_for(".index"))
-    if not current_user.is_following(user):
+    if not current_user.unfollow(user):
         flash("You are not following this user.")
         return redirect(url_for(".user", username=username))
-    current_user.unfollow(user)
     flash("You are not following %s anymore." % username)
     return redirect(url_for(".user", username=username))
 
@@ -206,8 +224,9 @@ def followers(username):
         flash("Invalid user.")
         return redirect(url_for(".index"))
     page = request.args.get("page", 1, type=int)
-    pagination = user.followers.paginate(
-        page, per_page=current_app.config["FLASKY_FOLLOWERS_PER_PAGE"],
+    pagination = paginate(
+        user.followers, page,
+        per_page=current_app.config["FLASKY_FOLLOWERS_PER_PAGE"],
         error_out=False
     )
     follows = [{"user": item.follower, "timestamp": item.timestamp}
@@ -227,8 +246,9 @@ def followed_by(username):
         flash("Invalid user.")
         return redirect(".index")
     page = request.args.get("page", 1, type=int)
-    pagination = user.followed.paginate(
-        page, per_page=current_app.config["FLASKY_FOLLOWERS_PER_PAGE"],
+    pagination = paginate(
+        user.followed, page,
+        per_page=current_app.config["FLASKY_FOLLOWERS_PER_PAGE"],
         error_out=False
     )
     follows = [{"user": item.followed, "timestamp": item.timestamp}
@@ -241,6 +261,14 @@ def followed_by(username):
                            follows=follows)
 
 
+@main.route("/suggestions")
+@login_required
+@permission_required(Permission.FOLLOW)
+def suggestions():
+    suggestions = current_user.suggestions()
+    return render_template("suggestions.html", suggestions=suggestions)
+
+
 @main.route("/all")
 @login_required
 def show_all():
@@ -267,10 +295,11 @@ def show_followed():
 @permission_required(Permission.MODERATE_COMMENTS)
 def moderate():
     page = request.args.get("page", 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"],
+    pagination = paginate(
+        Comment.query.order_by(Comment.timestamp.desc()), page,
+        per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"],
         error_out=False)
-    comments = pagination.items
+    comments = Comment.preload(pagination.items)
     return render_template("moderate.html", comments=comments, pagination=pagination, page=page)
 
 
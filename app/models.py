@@ -1,12 +1,21 @@
-from datetime import datetime
-from flask import current_app, url_for
+import hashlib
+import time
+from datetime import datetime, timedelta
+from flask import current_app
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from flask_login import UserMixin, AnonymousUserMixin
-from markdown import markdown
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from . import db, lm
 from .exceptions import ValidationError
-import bleach
+from .follow_graph import follow_graph
+from .render import render_markdown
+from .cache import app_cache
+from .last_seen import last_seen_buffer
+from .serializers import Field, URLField, select_fields
+from .page_cache import mark_pages_stale, on_model_changed, on_commit
 
 
 class Permission:
@@ -61,11 +70,41 @@ class Role(db.Model):
             role.permissions, role.default = roles[r]
             db.session.add(role)
         db.session.commit()
+        Role.invalidate_cache()
+
+    # roles 表很小且几乎不变，整张表缓存在进程内：
+    #     permissions: 角色 id -> 权限位
+    #     default: 默认角色 id
+    #     administrator: 管理员角色 id
+    # 本进程内修改角色时立即失效，其他进程的修改最多 FLASKY_ROLE_CACHE_TTL 秒后生效。
+    @staticmethod
+    def cached():
+        cache = app_cache("roles", maxsize=1, ttl=current_app.config["FLASKY_ROLE_CACHE_TTL"])
+        roles = cache.get("roles")
+        if roles is None:
+            roles = {"permissions": {}, "default": None, "administrator": None}
+            for id, permissions, default in db.session.query(Role.id, Role.permissions, Role.default):
+                roles["permissions"][id] = permissions
+                if default:
+                    roles["default"] = id
+                if permissions == 0xff:
+                    roles["administrator"] = id
+            cache.set("roles", roles)
+        return roles
+
+    @staticmethod
+    def invalidate_cache(*args):
+        app_cache("roles", maxsize=1).clear()
 
     def __repr__(self):
         return "<Role %r>" % self.name
 
 
+db.event.listen(Role, "after_insert", Role.invalidate_cache)
+db.event.listen(Role, "after_update", Role.invalidate_cache)
+db.event.listen(Role, "after_delete", Role.invalidate_cache)
+
+
 class Follow(db.Model):
     __tablename__ = "follows"
     # 联合主键
@@ -73,6 +112,178 @@ class Follow(db.Model):
     followed_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+    @staticmethod
+    def on_created(mapper, connection, target):
+        adjust_counter(connection, User, target.follower_id, "followed_count", 1)
+        adjust_counter(connection, User, target.followed_id, "follower_count", 1)
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        adjust_counter(connection, User, target.follower_id, "followed_count", -1)
+        adjust_counter(connection, User, target.followed_id, "follower_count", -1)
+
+
+# 物化时间线（写扩散）。
+# 文章发布时写入作者所有关注者的时间线，读取时只需按 (user_id, timestamp) 做一次索引范围扫描，
+# 不必再把 posts 和 follows 联结后排序。
+class TimelineEntry(db.Model):
+    __tablename__ = "timelines"
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey("posts.id"), primary_key=True)
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    timestamp = db.Column(db.DateTime)
+    __table_args__ = (
+        db.Index("ix_timelines_user_id_timestamp", "user_id", "timestamp"),
+    )
+
+    @staticmethod
+    def fan_out(connection, post):
+        TimelineEntry.fan_out_posts(connection, post.author_id, [post.id])
+
+    # 把同一作者的多篇文章一次写入所有关注者的时间线（关注者 × 文章），最后统一裁剪一次。
+    @staticmethod
+    def fan_out_posts(connection, author_id, post_ids):
+        follows = Follow.__table__
+        posts = Post.__table__
+        users = User.__table__
+        timelines = TimelineEntry.__table__
+        follower_count = connection.scalar(
+            db.select([users.c.follower_count]).where(users.c.id == author_id))
+        # 关注者过多的作者改为读取时拉取（混合模式），避免一次发布写入过多行。
+        if (follower_count or 0) > current_app.config["FLASKY_TIMELINE_FANOUT_LIMIT"]:
+            connection.execute(users.update().
+                               where(users.c.id == author_id).
+                               values(timeline_pull=True))
+            forget_cached_user(author_id)
+            return
+        connection.execute(timelines.insert().from_select(
+            ["user_id", "post_id", "author_id", "timestamp"],
+            db.select([follows.c.follower_id, posts.c.id, posts.c.author_id, posts.c.timestamp]).
+            where(follows.c.followed_id == author_id).
+            where(posts.c.id.in_(post_ids))))
+        TimelineEntry.prune(connection,
+                            db.select([follows.c.follower_id]).
+                            where(follows.c.followed_id == author_id))
+
+    @staticmethod
+    def backfill(connection, user, followed):
+        if followed.timeline_pull:
+            return
+        posts = Post.__table__
+        timelines = TimelineEntry.__table__
+        connection.execute(timelines.insert().from_select(
+            ["user_id", "post_id", "author_id", "timestamp"],
+            db.select([db.literal(user.id), posts.c.id, posts.c.author_id, posts.c.timestamp]).
+            where(posts.c.author_id == followed.id).
+            where(~posts.c.id.in_(db.select([timelines.c.post_id]).
+                                  where(timelines.c.user_id == user.id))).
+            order_by(posts.c.timestamp.desc()).
+            limit(current_app.config["FLASKY_TIMELINE_MAX_ENTRIES"])))
+        TimelineEntry.prune(connection, [user.id])
+
+    @staticmethod
+    def remove(connection, user, followed):
+        timelines = TimelineEntry.__table__
+        connection.execute(timelines.delete().
+                           where(timelines.c.user_id == user.id).
+                           where(timelines.c.author_id == followed.id))
+
+    # 每个用户只保留最新的 FLASKY_TIMELINE_MAX_ENTRIES 条。
+    # 相关子查询取出第 N 新的时间戳，条目不足 N 条时子查询为 NULL，不会删除任何行。
+    @staticmethod
+    def prune(connection, user_ids):
+        timelines = TimelineEntry.__table__
+        newer = timelines.alias()
+        boundary = db.select([newer.c.timestamp]).\
+            where(newer.c.user_id == timelines.c.user_id).\
+            order_by(newer.c.timestamp.desc()).\
+            limit(1).offset(current_app.config["FLASKY_TIMELINE_MAX_ENTRIES"] - 1).\
+            as_scalar()
+        connection.execute(timelines.delete().
+                           where(timelines.c.user_id.in_(user_ids)).
+                           where(timelines.c.timestamp < boundary))
+
+    @staticmethod
+    def rebuild():
+        db.session.query(TimelineEntry).delete(synchronize_session=False)
+        connection = db.session.connection()
+        for user in User.query.all():
+            for f in user.followed.all():
+                TimelineEntry.backfill(connection, user, f.followed)
+        db.session.commit()
+
+
+# 预先计算好的"你可能想关注的人"（好友的好友）。
+# 由 manage.py suggestions 命令批量生成，请求时只读取每个用户的前 N 条。
+class Suggestion(db.Model):
+    __tablename__ = "suggestions"
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    suggested_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    mutual_count = db.Column(db.Integer)
+    score = db.Column(db.Float, index=True)
+    suggested = db.relationship("User", foreign_keys=[suggested_id], lazy="joined")
+
+    # 用稀疏矩阵一次算出所有二度关系：
+    #     A[i, j] = 1 表示 i 关注了 j，则 (A·A)[i, k] 就是 i 关注的人中同时关注了 k 的人数（共同关注数）。
+    # 去掉自己和已经关注的人之后，按 共同关注数 + 近期发文活跃度 打分，每个用户保留前 top_n 个。
+    @staticmethod
+    def generate(top_n=None):
+        import numpy as np
+        from scipy import sparse
+
+        if top_n is None:
+            top_n = current_app.config["FLASKY_SUGGESTIONS_PER_USER"]
+        ids = np.array(sorted(row[0] for row in db.session.query(User.id)), dtype=np.int64)
+        db.session.query(Suggestion).delete(synchronize_session=False)
+        if len(ids) == 0:
+            db.session.commit()
+            return 0
+        n = len(ids)
+        edges = np.array(db.session.query(Follow.follower_id, Follow.followed_id).all(),
+                         dtype=np.int64).reshape(-1, 2)
+        rows = np.searchsorted(ids, edges[:, 0])
+        cols = np.searchsorted(ids, edges[:, 1])
+        follows = sparse.csr_matrix((np.ones(len(edges), dtype=np.int32), (rows, cols)),
+                                    shape=(n, n))
+        follows.data[:] = 1
+        mutual = (follows @ follows).tocsr()
+        # 去掉自己和已经关注的人
+        mask = (follows + sparse.identity(n, dtype=np.int32, format="csr")).astype(bool)
+        mutual = (mutual - mutual.multiply(mask)).tocsr()
+        mutual.eliminate_zeros()
+
+        since = datetime.utcnow() - timedelta(days=current_app.config["FLASKY_SUGGESTION_ACTIVITY_DAYS"])
+        activity = np.zeros(n)
+        recent = db.session.query(Post.author_id, db.func.count(Post.id)).\
+            filter(Post.timestamp >= since, Post.author_id != None).\
+            group_by(Post.author_id).all()
+        if recent:
+            recent = np.array(recent, dtype=np.int64)
+            activity[np.searchsorted(ids, recent[:, 0])] = np.log1p(recent[:, 1])
+        weight = current_app.config["FLASKY_SUGGESTION_ACTIVITY_WEIGHT"]
+
+        suggestions = []
+        for i in range(n):
+            start, end = mutual.indptr[i], mutual.indptr[i + 1]
+            if start == end:
+                continue
+            candidates = mutual.indices[start:end]
+            counts = mutual.data[start:end]
+            scores = counts + weight * activity[candidates]
+            if len(scores) > top_n:
+                best = np.argpartition(-scores, top_n)[:top_n]
+            else:
+                best = np.arange(len(scores))
+            for j in best:
+                suggestions.append({"user_id": int(ids[i]),
+                                    "suggested_id": int(ids[candidates[j]]),
+                                    "mutual_count": int(counts[j]),
+                                    "score": float(scores[j])})
+        if suggestions:
+            db.session.execute(Suggestion.__table__.insert(), suggestions)
+        db.session.commit()
+        return len(suggestions)
+
 
 class User(db.Model, UserMixin):
     __tablename__ = "users"
@@ -91,6 +302,16 @@ class User(db.Model, UserMixin):
     # 所以每次需要生成默认值时，db.Column() 都会调用指定的函数。
     member_since = db.Column(db.DateTime(), default=datetime.utcnow)
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    # API 令牌的吊销纪元，修改密码等操作时加一。
+    token_epoch = db.Column(db.Integer, default=0)
+    # 关注者过多、发布文章时不做写扩散的作者，其文章在读取时间线时直接拉取。
+    timeline_pull = db.Column(db.Boolean, default=False)
+    # 冗余计数，由 Post、Comment、Follow 的插入/删除事件维护，避免每次显示资料页都执行 COUNT。
+    # 与自关注一样，follower_count 和 followed_count 都包含用户自己。
+    post_count = db.Column(db.Integer, default=0)
+    follower_count = db.Column(db.Integer, default=0)
+    followed_count = db.Column(db.Integer, default=0)
+    comment_count = db.Column(db.Integer, default=0)
     posts = db.relationship("Post", backref="author", lazy="dynamic")
     # 为了消除外键间的歧义，定义关系时必须使用可选参数 foreign_keys 指定的外键。
     # 而且，db.backref() 参数并不是指定这两个关系之间的引用关系，而是回引Follow 模型。
@@ -138,21 +359,38 @@ class User(db.Model, UserMixin):
             except IntegrityError:
                 db.session.rollback()
 
+    # 根据实际数据重新计算所有冗余计数，用于修复计数偏差。
+    @staticmethod
+    def recount():
+        users = User.__table__
+        follows = Follow.__table__
+        db.session.execute(users.update().values(
+            post_count=db.select([db.func.count()]).
+            where(Post.__table__.c.author_id == users.c.id).as_scalar(),
+            follower_count=db.select([db.func.count()]).
+            where(follows.c.followed_id == users.c.id).as_scalar(),
+            followed_count=db.select([db.func.count()]).
+            where(follows.c.follower_id == users.c.id).as_scalar(),
+            comment_count=db.select([db.func.count()]).
+            where(Comment.__table__.c.author_id == users.c.id).as_scalar()))
+        db.session.commit()
+        if current_app.config["FLASKY_USER_CACHE_TTL"]:
+            user_cache().clear()
+
     @staticmethod
     def add_self_follows():
         for user in User.query.all():
-            if not user.is_following(user):
-                user.follow(user)
-                db.session.add(user)
-                db.session.commit()
+            user.follow(user)
 
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
-        if self.role is None:
+        # 角色 id 取自进程内的角色缓存，不必为每个新用户查询 roles 表。
+        if self.role is None and self.role_id is None:
+            roles = Role.cached()
             if self.email == current_app.config["FLASKY_ADMIN"]:
-                self.role = Role.query.filter_by(permissions=0xff).first()
-            if self.role is None:
-                self.role = Role.query.filter_by(default=True).first()
+                self.role_id = roles["administrator"]
+            if self.role_id is None:
+                self.role_id = roles["default"]
         self.followed.append(Follow(followed=self))
 
     @property
@@ -162,6 +400,7 @@ class User(db.Model, UserMixin):
     @password.setter
     def password(self, password):
         self.password_hash = generate_password_hash(password)
+        self.revoke_auth_tokens()
 
     def verify_password(self, password):
         return check_password_hash(self.password_hash, password)
@@ -223,66 +462,176 @@ class User(db.Model, UserMixin):
         db.session.commit()
         return True
 
+    # 已经加载到内存中的 role 直接使用；否则按 role_id 从角色缓存中取权限位，不触发延迟加载。
     def can(self, permissions):
-        return self.role is not None and \
-               (self.role.permissions & permissions) == permissions
+        role = self.__dict__.get("role")
+        if role is not None:
+            role_permissions = role.permissions
+        elif self.role_id is not None:
+            role_permissions = Role.cached()["permissions"].get(self.role_id)
+        else:
+            role_permissions = None
+        return role_permissions is not None and \
+               (role_permissions & permissions) == permissions
 
     def is_administrator(self):
         return self.can(Permission.ADMINISTER)
 
+    # 只更新内存中的值（不标记为已修改），数据库由 last_seen 缓冲区批量写回。
     def ping(self):
-        self.last_seen = datetime.utcnow()
-        db.session.add(self)
-        db.session.commit()
-
+        now = datetime.utcnow()
+        set_committed_value(self, "last_seen", now)
+        buffer = last_seen_buffer()
+        buffer.add(self.id, now)
+        buffer.maybe_flush()
+
+    # 写操作以数据库为准，不使用关注关系索引：其他进程的修改要过一段时间才会反映到本进程的索引中，
+    # 按索引判断可能重复插入 Follow，或拒绝重新关注已被其他进程取消的关注。
+    # 顺便用查询结果校正本进程的索引。返回值表示是否真的做了修改。
     def follow(self, user):
-        if not self.is_following(user):
-            f = Follow(follower=self, followed=user)
-            db.session.add(f)
-            db.session.commit()
+        from sqlalchemy.exc import IntegrityError
+        graph = follow_graph()
+        if self.followed.filter_by(followed_id=user.id).first() is None:
+            try:
+                f = Follow(follower=self, followed=user)
+                db.session.add(f)
+                db.session.flush()
+            except IntegrityError:
+                # 其他进程在查询之后刚好插入了同一关注关系。
+                db.session.rollback()
+                created = False
+            else:
+                TimelineEntry.backfill(db.session.connection(), self, user)
+                db.session.commit()
+                created = True
+        else:
+            created = False
+        if graph is not None:
+            graph.add(self.id, user.id)
+        return created
 
     def unfollow(self, user):
+        graph = follow_graph()
         f = self.followed.filter_by(followed_id=user.id).first()
         if f:
             db.session.delete(f)
+            TimelineEntry.remove(db.session.connection(), self, user)
             db.session.commit()
+        if graph is not None:
+            graph.remove(self.id, user.id)
+        return f is not None
 
+    # 只用于显示：启用了关注关系索引时直接在内存中判断（可能稍有滞后），否则查询数据库。
     def is_following(self, user):
+        graph = follow_graph()
+        if graph is not None and self.id is not None and user.id is not None:
+            return graph.is_following(self.id, user.id)
         return self.followed.filter_by(followed_id=user.id).first() is not None
 
     def is_followed_by(self, user):
+        graph = follow_graph()
+        if graph is not None and self.id is not None and user.id is not None:
+            return graph.is_following(user.id, self.id)
         return self.followers.filter_by(follower_id=user.id).first() is not None
 
     # followed_posts() 方法定义为属性，因此调用时无需加 ()。如此一来，所有关系的句法都一样了。
+    #
+    # 时间线从物化的 timelines 表读取；只有关注了"拉取模式"作者时才需要额外合并这些作者的文章。
     @property
     def followed_posts(self):
-        return Post.query.join(Follow, Follow.followed_id == Post.author_id).filter(Follow.follower_id == self.id)
-
-    def to_json(self):
-        json_user = {
-            "url": url_for("api.get_user", id=self.id, _external=True),
-            "username": self.username,
-            "member_since": self.member_since,
-            "last_seen": self.last_seen,
-            "posts": url_for("api.get_user_posts", id=self.id, _external=True),
-            "followed_posts": url_for("api.get_user_followed_posts", id=self.id, _external=True),
-            "post_count": self.posts.count()
-        }
-        return json_user
-
+        pulled = [row[0] for row in
+                  db.session.query(Follow.followed_id).
+                  join(User, User.id == Follow.followed_id).
+                  filter(Follow.follower_id == self.id, User.timeline_pull == True).all()]
+        if not pulled:
+            return Post.query.join(TimelineEntry, TimelineEntry.post_id == Post.id).\
+                filter(TimelineEntry.user_id == self.id)
+        timeline = db.session.query(TimelineEntry.post_id).filter(TimelineEntry.user_id == self.id)
+        return Post.query.filter(db.or_(Post.id.in_(timeline), Post.author_id.in_(pulled)))
+
+    # 读取预先计算好的推荐，过滤掉生成之后才关注的人。
+    def suggestions(self, limit=None):
+        if limit is None:
+            limit = current_app.config["FLASKY_SUGGESTIONS_PER_USER"]
+        followed = db.session.query(Follow.followed_id).filter(Follow.follower_id == self.id)
+        return Suggestion.query.filter(Suggestion.user_id == self.id,
+                                       ~Suggestion.suggested_id.in_(followed)).\
+            order_by(Suggestion.score.desc(), Suggestion.mutual_count.desc()).\
+            limit(limit).all()
+
+    # to_json() 输出的字段及其取值方式。
+    # 客户端用 ?fields= 只请求部分字段时，只计算这些字段，跳过不需要的 url_for() 等开销。
+    # API 视图通过 compiled_serializer() 使用同一份定义，见 app/serializers.py。
+    json_fields = {
+        "url": URLField("api.get_user"),
+        "username": Field("username"),
+        "member_since": Field("member_since"),
+        "last_seen": Field("last_seen"),
+        "posts": URLField("api.get_user_posts"),
+        "followed_posts": URLField("api.get_user_followed_posts"),
+        "post_count": Field("post_count")
+    }
+
+    def to_json(self, fields=None):
+        return select_fields(self, User.json_fields, fields)
+
+    # 令牌中带上角色 id、确认状态和吊销纪元，API 请求凭令牌和进程内的角色缓存即可完成授权，
+    # 不必加载用户。权限位不写入令牌，而是按角色 id 从 Role.cached() 中取，修改角色的权限后立即生效。
     def generate_auth_token(self, expiration):
         s = Serializer(current_app.config["SECRET_KEY"], expires_in=expiration)
-        return s.dumps({"id": self.id}).decode('ascii')
+        return s.dumps({"id": self.id,
+                        "role_id": self.role_id,
+                        "confirmed": bool(self.confirmed),
+                        "epoch": self.token_epoch or 0}).decode('ascii')
         # return s.dumps({"id": self.id})
 
+    # 吊销此前签发的所有令牌：令牌中的纪元小于用户当前纪元即视为无效。
+    def revoke_auth_tokens(self):
+        self.token_epoch = (self.token_epoch or 0) + 1
+        if self.id is not None:
+            token_epochs()[self.id] = self.token_epoch
+
+    # 只校验令牌签名和有效期（不访问数据库），返回其中的用户 id；令牌无效时返回 None。
+    # 令牌是否已被吊销仍由 verify_auth_token() 判断。
+    @staticmethod
+    def auth_token_user_id(token):
+        s = Serializer(current_app.config["SECRET_KEY"])
+        try:
+            return int(s.loads(token)["id"])
+        except:
+            return None
+
+    # 验证通过的令牌在进程内缓存 FLASKY_TOKEN_CACHE_TTL 秒，期间同一令牌的请求不访问数据库。
+    # 缓存未命中时只查询一次用户的吊销纪元；本进程内吊销的令牌立即失效，
+    # 其他进程吊销的令牌最多在缓存时间过后失效。
     @staticmethod
     def verify_auth_token(token):
+        cache = app_cache("tokens",
+                          maxsize=current_app.config["FLASKY_TOKEN_CACHE_SIZE"],
+                          ttl=current_app.config["FLASKY_TOKEN_CACHE_TTL"])
+        key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        user = cache.get(key)
+        if user is not None:
+            if token_epochs().get(user.id, user.epoch) <= user.epoch:
+                return user
+            cache.delete(key)
+            return None
         s = Serializer(current_app.config["SECRET_KEY"])
         try:
-            data = s.loads(token)
+            data, header = s.loads(token, return_header=True)
         except:
             return None
-        return User.query.get(data["id"])
+        if "role_id" not in data or not data["confirmed"]:
+            # 旧格式的令牌，或签发时账户尚未确认（之后可能已经确认），以数据库为准。
+            return User.query.get(data["id"])
+        epoch = db.session.query(User.token_epoch).filter_by(id=data["id"]).scalar()
+        if epoch is None or data["epoch"] < epoch:
+            return None
+        user = TokenUser(data["id"], data["role_id"], data["confirmed"], data["epoch"])
+        ttl = min(current_app.config["FLASKY_TOKEN_CACHE_TTL"], header["exp"] - time.time())
+        if ttl > 0:
+            cache.set(key, user, ttl=ttl)
+        return user
 
     def __repr__(self):
         return "<User %r>" % self.username
@@ -296,6 +645,66 @@ class AnonymousUser(AnonymousUserMixin):
         return False
 
 
+# 由 API 令牌还原出的用户。
+# 授权需要的 id、角色和确认状态都来自令牌本身，权限位来自角色缓存；
+# 访问其他属性时才从数据库加载真正的 User。
+class TokenUser:
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, id, role_id, confirmed, epoch):
+        self.id = id
+        self.role_id = role_id
+        self.confirmed = confirmed
+        self.epoch = epoch
+
+    def can(self, permissions):
+        role_permissions = Role.cached()["permissions"].get(self.role_id) or 0
+        return (role_permissions & permissions) == permissions
+
+    def is_administrator(self):
+        return self.can(Permission.ADMINISTER)
+
+    def get_id(self):
+        return str(self.id)
+
+    def _get_current_object(self):
+        return User.query.get(self.id)
+
+    def __getattr__(self, name):
+        return getattr(self._get_current_object(), name)
+
+    def __eq__(self, other):
+        return isinstance(other, (User, TokenUser)) and other.id == self.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+def token_epochs():
+    return current_app.extensions.setdefault("token_epochs", {})
+
+
+# Markdown 渲染结果的持久化缓存，键是正文和允许标签集合的哈希。
+class RenderedHTML(db.Model):
+    __tablename__ = "rendered_html"
+    hash = db.Column(db.String(64), primary_key=True)
+    html = db.Column(db.Text)
+
+
+# 更新文章或评论时把版本号加一。
+# 版本号只用于生成 ETag，不用 SQLAlchemy 的 version_id_col：那会把每次更新都变成乐观锁检查，
+# 并发的两次编辑、或与 manage.py rerender 同时进行的编辑会抛出 StaleDataError。
+# 这里用 SQL 表达式 version + 1 在数据库中自增，并发更新时也不会丢失增量。
+def bump_version(mapper, connection, target):
+    if object_session(target).is_modified(target, include_collections=False):
+        target.version = type(target).version + 1
+
+
 class Post(db.Model):
     __tablename__ = "posts"
     id = db.Column(db.Integer, primary_key=True)
@@ -303,7 +712,23 @@ class Post(db.Model):
     body_html = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     author_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
+    comment_count = db.Column(db.Integer, default=0)
+    # 行版本号，每次通过 ORM 更新文章时加一（见 bump_version），API 据此生成 ETag。
+    version = db.Column(db.Integer, nullable=False, default=1)
     comments = db.relationship("Comment", backref="post", lazy="dynamic")
+    # 修改允许的标签后，用 manage.py rerender 重新生成已保存的 body_html。
+    allowed_tags = ["a", "abbr", "acronym",
+                    "b", "blockquote",
+                    "code",
+                    "em",
+                    "i",
+                    "li",
+                    "ol",
+                    "pre",
+                    "strong",
+                    "ul",
+                    "h1", "h2", "h3",
+                    "p"]
 
     @staticmethod
     def generate_fake(count=100):
@@ -322,35 +747,31 @@ class Post(db.Model):
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ["a", "abbr", "acronym",
-                        "b", "blockquote",
-                        "code",
-                        "em",
-                        "i",
-                        "li",
-                        "ol",
-                        "pre",
-                        "strong",
-                        "ul",
-                        "h1", "h2", "h3",
-                        "p"]
         # 由于 Markdown 规范没有为自动生成链接提供官方支持，
         # 因此需要使用由 Bleach 提供的 linkify() 函数把纯文本中的 URL 转换成适当的 <a> 链接。
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format="html"),
-            tags=allowed_tags, strip=True))
-
-    def to_json(self):
-        json_post = {
-            "url": url_for("api.get_post", id=self.id, _external=True),
-            "body": self.body,
-            "body_html": self.body_html,
-            "timestamp": self.timestamp,
-            "author": url_for("api.get_user", id=self.author_id, _external=True),
-            "comments": url_for("api.get_post_comments", id=self.id, _external=True),
-            "comment_count": self.comments.count()
-        }
-        return json_post
+        # render_markdown() 按正文和标签集合的哈希缓存渲染结果，相同的正文只渲染一次。
+        target.body_html = render_markdown(value, Post.allowed_tags)
+
+    json_fields = {
+        "url": URLField("api.get_post"),
+        "body": Field("body"),
+        "body_html": Field("body_html"),
+        "timestamp": Field("timestamp"),
+        "author": URLField("api.get_user", "author_id"),
+        "comments": URLField("api.get_post_comments"),
+        "comment_count": Field("comment_count")
+    }
+
+    def to_json(self, fields=None):
+        return select_fields(self, Post.json_fields, fields)
+
+    # 为一整页文章批量加载作者：一次 IN 查询取出所有作者。
+    # 否则模板中逐篇访问 post.author 会产生 N+1 次查询。评论数量直接读冗余的 comment_count 列。
+    @staticmethod
+    def preload(posts):
+        posts = list(posts)
+        load_authors(posts)
+        return posts
 
     @staticmethod
     def from_json(json_post):
@@ -361,10 +782,53 @@ class Post(db.Model):
             raise ValidationError("post does not have a body")
         return Post(body=body)
 
+    @staticmethod
+    def on_created(mapper, connection, target):
+        if target.author_id is not None:
+            adjust_counter(connection, User, target.author_id, "post_count", 1)
+            TimelineEntry.fan_out(connection, target)
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        adjust_counter(connection, User, target.author_id, "post_count", -1)
+
+    # 批量写入同一作者的多篇文章（from_json() 得到的未保存对象），按原顺序返回新文章的 id。
+    # 插入方式取决于数据库（见 insert_rows()），SQLite 上是一条 executemany INSERT。调用方负责提交事务。
+    # 批量插入不触发 ORM 事件，文章计数和时间线写扩散在这里按整批各做一次。
+    @staticmethod
+    def bulk_create(author_id, posts):
+        if not posts:
+            return []
+        table = Post.__table__
+        connection = db.session.connection()
+        timestamp = datetime.utcnow()
+        ids = insert_rows(connection, table, [{"body": post.body,
+                                               "body_html": post.body_html,
+                                               "timestamp": timestamp,
+                                               "author_id": author_id} for post in posts])
+        adjust_counter(connection, User, author_id, "post_count", len(ids))
+        TimelineEntry.fan_out_posts(connection, author_id, ids)
+        mark_pages_stale(db.session)
+        return ids
+
+    # 根据实际数据重新计算所有冗余计数，用于修复计数偏差。
+    @staticmethod
+    def recount():
+        posts = Post.__table__
+        comments = Comment.__table__
+        db.session.execute(posts.update().values(
+            comment_count=db.select([db.func.count()]).
+            where(comments.c.post_id == posts.c.id).as_scalar()))
+        db.session.commit()
+
 
 # on_changed_body 函数注册在 Post 的 body 字段上，是 SQLAlchemy "set" 事件的监听程序，
 # 这意味着只要这个类实例的 body 字段设了新值，函数就会自动被调用。
 db.event.listen(Post.body, "set", Post.on_changed_body)
+# 文章插入数据库后，在同一个事务中把它写入关注者的时间线。
+db.event.listen(Post, "after_insert", Post.on_created)
+db.event.listen(Post, "after_delete", Post.on_deleted)
+db.event.listen(Post, "before_update", bump_version)
 
 
 class Comment(db.Model):
@@ -376,24 +840,24 @@ class Comment(db.Model):
     disabled = db.Column(db.Boolean)
     author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     post_id = db.Column(db.Integer, db.ForeignKey("posts.id"))
+    version = db.Column(db.Integer, nullable=False, default=1)
+    allowed_tags = ["a", "abbr", "acronym", "b", "code", "em", "i", "strong"]
 
     @staticmethod
     def on_change_body(target, value, oldvalue, initiator):
-        allowed_tags = ["a", "abbr", "acronym", "b", "code", "em", "i", "strong"]
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format="html"),
-            tags=allowed_tags, strip=True))
-
-    def to_json(self):
-        json_comment = {
-            "url": url_for("api.get_comment", id=self.id, _external=True),
-            "post": url_for("api.get_post", id=self.post_id, _external=True),
-            "body": self.body,
-            "body_html": self.body_html,
-            "timestamp": self.timestamp,
-            "author": url_for("api.get_user", id=self.author_id, _external=True)
-        }
-        return json_comment
+        target.body_html = render_markdown(value, Comment.allowed_tags)
+
+    json_fields = {
+        "url": URLField("api.get_comment"),
+        "post": URLField("api.get_post", "post_id"),
+        "body": Field("body"),
+        "body_html": Field("body_html"),
+        "timestamp": Field("timestamp"),
+        "author": URLField("api.get_user", "author_id")
+    }
+
+    def to_json(self, fields=None):
+        return select_fields(self, Comment.json_fields, fields)
 
     @staticmethod
     def from_json(json_comment):
@@ -402,16 +866,149 @@ class Comment(db.Model):
             raise ValidationError("comment does not have a body")
         return Comment(body=body)
 
+    @staticmethod
+    def preload(comments):
+        comments = list(comments)
+        load_authors(comments)
+        return comments
+
+    @staticmethod
+    def on_created(mapper, connection, target):
+        adjust_counter(connection, Post, target.post_id, "comment_count", 1)
+        adjust_counter(connection, User, target.author_id, "comment_count", 1)
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        adjust_counter(connection, Post, target.post_id, "comment_count", -1)
+        adjust_counter(connection, User, target.author_id, "comment_count", -1)
+
+    # 与 Post.bulk_create() 相同，批量写入同一作者对同一篇文章的多条评论。
+    @staticmethod
+    def bulk_create(author_id, post_id, comments):
+        if not comments:
+            return []
+        table = Comment.__table__
+        connection = db.session.connection()
+        timestamp = datetime.utcnow()
+        ids = insert_rows(connection, table, [{"body": comment.body,
+                                               "body_html": comment.body_html,
+                                               "timestamp": timestamp,
+                                               "author_id": author_id,
+                                               "post_id": post_id} for comment in comments])
+        adjust_counter(connection, Post, post_id, "comment_count", len(ids))
+        adjust_counter(connection, User, author_id, "comment_count", len(ids))
+        mark_pages_stale(db.session)
+        return ids
+
+
+# 插入多行并按顺序返回它们的 id。
+# 不能插入后再按 (作者, 时间戳) 查回 id：时间戳只精确到秒的数据库中，同一秒内的其他插入也会被查到。
+#     支持 RETURNING 的数据库（PostgreSQL 等）：一条多行 INSERT ... RETURNING，
+#         同一条语句中的自增 id 按 VALUES 的顺序递增，排序后即与 rows 一一对应；
+#     SQLite：一条 executemany INSERT。插入后本事务持有写锁，其他连接无法插入，
+#         新行的 id 依次为原最大 id 加一，因此就是插入后 max(id) 往前的连续 len(rows) 个；
+#     其他数据库（MySQL 等）：多行插入分配的自增 id 不保证连续，只能逐行插入，从 inserted_primary_key 取得 id。
+def insert_rows(connection, table, rows):
+    if connection.dialect.implicit_returning:
+        return sorted(row[0] for row in connection.execute(
+            table.insert().values(rows).returning(table.c.id)))
+    if connection.dialect.name == "sqlite":
+        connection.execute(table.insert(), rows)
+        last_id = connection.scalar(db.select([db.func.max(table.c.id)]))
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+    return [connection.execute(table.insert(), row).inserted_primary_key[0] for row in rows]
+
+
+# 在触发事件的同一个连接（同一个事务）中更新冗余计数。
+def adjust_counter(connection, model, id, column, delta):
+    if id is None:
+        return
+    table = model.__table__
+    connection.execute(table.update().
+                       where(table.c.id == id).
+                       values({column: db.func.coalesce(table.c[column], 0) + delta}))
+    if model is User:
+        forget_cached_user(id)
+
+
+# 用一次查询取出所有作者，再直接填入各对象的 author 关系，不触发延迟加载。
+def load_authors(items):
+    author_ids = set(item.author_id for item in items if item.author_id is not None)
+    if not author_ids:
+        return
+    authors = dict((u.id, u) for u in User.query.filter(User.id.in_(author_ids)).all())
+    for item in items:
+        if item.author_id in authors:
+            set_committed_value(item, "author", authors[item.author_id])
+
 
 # on_changed_body 函数注册在 Post 的 body 字段上，是 SQLAlchemy "set" 事件的监听程序，
 # 这意味着只要这个类实例的 body 字段设了新值，函数就会自动被调用。
 db.event.listen(Comment.body, "set", Comment.on_change_body)
+db.event.listen(Comment, "after_insert", Comment.on_created)
+db.event.listen(Comment, "after_delete", Comment.on_deleted)
+db.event.listen(Comment, "before_update", bump_version)
+# 关注关系增删时同步更新双方的关注计数。
+db.event.listen(Follow, "after_insert", Follow.on_created)
+db.event.listen(Follow, "after_delete", Follow.on_deleted)
+# 这些模型的变化会反映在匿名用户看到的页面上，提交后使整页缓存失效。
+for model in (Post, Comment, User, Follow):
+    for name in ("after_insert", "after_update", "after_delete"):
+        db.event.listen(model, name, on_model_changed)
+db.event.listen(Session, "after_commit", on_commit)
 
 # 将 AnonymousUser 设为用户未登录时 current_user 的值。
 # 这样程序不用先检查用户是否登录，就能自由调用 current_user.can() 和 current_user.is_administrator()。
 lm.anonymous_user = AnonymousUser
 
 
+# 每个带会话 cookie 的请求都要加载当前用户，因此：
+#     用一条联结查询同时取出用户和角色；
+#     可选地（FLASKY_USER_CACHE_TTL 大于 0 时）在进程内缓存用户的列值快照，
+#     命中时直接在当前会话中还原出用户对象，不访问数据库。
+#     通过 ORM 修改用户时（after_update 事件）快照失效；
+#     用 Core 语句直接修改 users 表的地方（冗余计数、last_seen 批量写回、timeline_pull）
+#     要自己调用 forget_cached_user()。
+def user_cache():
+    return app_cache("users",
+                     maxsize=current_app.config["FLASKY_USER_CACHE_SIZE"],
+                     ttl=current_app.config["FLASKY_USER_CACHE_TTL"])
+
+
+def forget_cached_user(*user_ids):
+    if current_app.config["FLASKY_USER_CACHE_TTL"]:
+        cache = user_cache()
+        for user_id in user_ids:
+            cache.delete(user_id)
+
+
+def forget_user(mapper, connection, target):
+    forget_cached_user(target.id)
+
+
 @lm.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    if not current_app.config["FLASKY_USER_CACHE_TTL"]:
+        return User.query.options(db.joinedload(User.role)).get(user_id)
+    user = db.session.identity_map.get(identity_key(User, user_id))
+    if user is not None:
+        return user
+    cache = user_cache()
+    snapshot = cache.get(user_id)
+    if snapshot is None:
+        user = User.query.options(db.joinedload(User.role)).get(user_id)
+        if user is not None:
+            cache.set(user_id, dict((attr.key, getattr(user, attr.key))
+                                    for attr in User.__mapper__.column_attrs))
+        return user
+    user = User.__mapper__.class_manager.new_instance()
+    for key, value in snapshot.items():
+        set_committed_value(user, key, value)
+    make_transient_to_detached(user)
+    db.session.add(user)
+    return user
+
+
+db.event.listen(User, "after_update", forget_user)
+db.event.listen(User, "after_delete", forget_user)
@@ -0,0 +1,133 @@
+import time
+from functools import wraps
+from threading import Lock
+from flask import request, session, current_app, make_response, has_app_context
+from flask_login import current_user
+from sqlalchemy.orm import object_session
+from .cache import app_cache
+
+
+# 匿名用户的整页缓存。
+# 匿名访问者看到的页面完全相同，因此按 (端点, URL 参数, 页码) 缓存视图生成的完整响应。
+#
+# 失效：文章、评论、用户、关注关系发生变化并提交后，本进程的页面"代数"加一，
+# 旧代的缓存条目随即变为过期（其他进程中的条目最多在 FLASKY_PAGE_CACHE_TTL 秒后过期）。
+# 过期条目在 FLASKY_PAGE_CACHE_STALE 秒内仍可使用：只有一个请求负责重新生成，
+# 同一时间的其他请求直接返回旧页面（stale-while-revalidate），不会一起涌向数据库。
+class PageCache:
+    def __init__(self):
+        self.generation = 0
+        self._refreshing = set()
+        self._lock = Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+
+    # 只有第一个发现条目过期的请求返回 True，由它重新生成页面。
+    def claim(self, key):
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def release(self, key):
+        with self._lock:
+            self._refreshing.discard(key)
+
+
+def page_cache():
+    cache = current_app.extensions.get("page_cache")
+    if cache is None:
+        cache = current_app.extensions.setdefault("page_cache", PageCache())
+    return cache
+
+
+def page_entries():
+    return app_cache("pages", maxsize=current_app.config["FLASKY_PAGE_CACHE_SIZE"])
+
+
+# 已登录用户、带有待显示的闪现消息的请求都不能使用共享的页面。
+def cacheable():
+    return request.method == "GET" and \
+        current_app.config["FLASKY_PAGE_CACHE_TTL"] > 0 and \
+        not current_user.is_authenticated and \
+        "_flashes" not in session
+
+
+def page_key():
+    return (request.endpoint, tuple(sorted(request.view_args.items())),
+            request.args.get("page", 1, type=int))
+
+
+def cached_page(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        config = current_app.config
+        if not cacheable():
+            response = make_response(f(*args, **kwargs))
+            response.cache_control.private = True
+            return response
+        cache = page_cache()
+        entries = page_entries()
+        key = page_key()
+        ttl = config["FLASKY_PAGE_CACHE_TTL"]
+        stale = config["FLASKY_PAGE_CACHE_STALE"]
+        entry = entries.get(key)
+        if entry is not None:
+            body, mimetype, created, generation = entry
+            age = time.monotonic() - created
+            if generation == cache.generation and age < ttl:
+                return cached_response(body, mimetype, ttl, stale, "HIT")
+        claimed = cache.claim(key)
+        if entry is not None and age < ttl + stale and not claimed:
+            return cached_response(body, mimetype, ttl, stale, "STALE")
+        # 没有可用的旧页面时，即使其他请求正在重新生成也只能自己生成；
+        # 但只有取得了 claim 的请求才能释放它，否则会释放掉正在重新生成页面的请求的 claim。
+        try:
+            generation = cache.generation
+            response = make_response(f(*args, **kwargs))
+            # 视图修改了会话（例如设置了 Cookie）的响应与具体访问者有关，不能共享。
+            if response.status_code == 200 and not session.modified and \
+                    "Set-Cookie" not in response.headers:
+                entries.set(key, (response.get_data(), response.mimetype,
+                                  time.monotonic(), generation),
+                            ttl=ttl + stale)
+                set_cache_headers(response, ttl, stale, "MISS")
+            return response
+        finally:
+            if claimed:
+                cache.release(key)
+    return decorated_function
+
+
+def cached_response(body, mimetype, ttl, stale, status):
+    response = current_app.response_class(body, mimetype=mimetype)
+    set_cache_headers(response, ttl, stale, status)
+    return response
+
+
+# 允许上游代理缓存匿名页面；已登录用户带有会话 Cookie，Vary: Cookie 使代理区分对待。
+def set_cache_headers(response, ttl, stale, status):
+    response.cache_control.public = True
+    response.cache_control.max_age = ttl
+    response.headers["Cache-Control"] += ", stale-while-revalidate=%d" % stale
+    response.vary.add("Cookie")
+    response.headers["X-Page-Cache"] = status
+
+
+# 映射器事件中只做标记，提交之后再使缓存失效：
+# 如果在提交前就失效，并发的请求可能用尚未提交的旧数据重新生成页面，并被当作最新的页面缓存下来。
+def mark_pages_stale(session):
+    if session is not None:
+        session.info["pages_stale"] = True
+
+
+def on_model_changed(mapper, connection, target):
+    mark_pages_stale(object_session(target))
+
+
+def on_commit(session):
+    if session.info.pop("pages_stale", False) and has_app_context():
+        page_cache().invalidate()
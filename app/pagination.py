@@ -0,0 +1,52 @@
+from flask import current_app, abort
+from flask_sqlalchemy import Pagination
+from .cache import app_cache
+
+
+def count_cache():
+    return app_cache("count",
+                     maxsize=current_app.config["FLASKY_COUNT_CACHE_SIZE"],
+                     ttl=current_app.config["FLASKY_COUNT_CACHE_TTL"])
+
+
+# 同一条 SQL、同样的参数，统计结果相同，因此用编译后的 COUNT 语句和参数作为缓存键。
+def count_key(query):
+    compiled = query.order_by(None).statement.compile()
+    return str(compiled), tuple(sorted(compiled.params.items()))
+
+
+# 返回 (总数, 是否为近似值)。
+# 命中缓存时总数可能落后于数据库最多 FLASKY_COUNT_CACHE_TTL 秒，因此标记为近似值。
+def cached_count(query):
+    cache = count_cache()
+    key = count_key(query)
+    total = cache.get(key)
+    if total is not None:
+        return total, True
+    total = query.order_by(None).count()
+    cache.set(key, total)
+    return total, False
+
+
+# 代替 Flask-SQLAlchemy 的 paginate()，返回同样的 Pagination 对象，但总数来自 cached_count()。
+# 多取一条记录可以顺便校正总数：
+#     最后一页（没有多出的记录）时，总数可以直接算出来，完全不需要 COUNT(*)；
+#     否则总数至少是已经看到的记录数，缓存值偏小时以此为准。
+def paginate(query, page, per_page, error_out=False):
+    if error_out and page < 1:
+        abort(404)
+    items = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if not items and page != 1 and error_out:
+        abort(404)
+    if not has_more and (items or page == 1):
+        total = (page - 1) * per_page + len(items)
+        approximate = False
+        count_cache().set(count_key(query), total)
+    else:
+        total, approximate = cached_count(query)
+        total = max(total, (page - 1) * per_page + len(items) + has_more)
+    pagination = Pagination(query, page, per_page, total, items)
+    pagination.approximate = approximate
+    return pagination
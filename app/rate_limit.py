@@ -0,0 +1,101 @@
+import math
+import time
+from threading import Lock
+from flask import request, current_app, jsonify, g
+from werkzeug.utils import import_string
+from .cache import TTLCache
+
+
+# 进程内的令牌桶存储。
+# 每个键对应 (剩余令牌数, 上次更新时间)，条目在桶重新装满所需的时间后过期（过期即视为满桶），
+# 条目数受 maxsize 限制，不会因为大量不同的客户端而无限增长。
+#
+# 多进程部署时可以在 FLASKY_RATELIMIT_BACKEND 中指定共享的实现（例如基于 Redis），
+# 只需提供同样的 consume(key, capacity, period, cost) 方法。
+class MemoryBackend:
+    def __init__(self, maxsize=10000):
+        self._buckets = TTLCache(maxsize=maxsize)
+        self._lock = Lock()
+
+    # 从 key 对应的桶（容量 capacity，每 period 秒补满）中取出 cost 个令牌，令牌不足时一个也不取。
+    # 返回 (是否允许, 剩余令牌数, 补满所需秒数)。
+    def consume(self, key, capacity, period, cost=1):
+        rate = capacity / period
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            refill = (capacity - tokens) / rate
+            self._buckets.set(key, (tokens, now), ttl=refill)
+        return allowed, tokens, refill
+
+
+# API 限流。
+# 在 before_request 中最先执行，不访问数据库：
+# 使用令牌认证时按令牌中的用户 id 计数（只校验签名，同一用户申请的多个令牌共用一个桶），
+# 其他请求（包括 email/密码认证）按客户端 IP 计数——密码此时尚未验证，
+# 按声称的 email 计数会让任何知道对方 email 的人耗尽对方的配额。
+# 读请求（GET/HEAD/OPTIONS）和写请求使用不同的桶和配额，超出配额时直接返回 429。
+class RateLimiter:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config["FLASKY_RATELIMIT_BACKEND"]
+        if backend is None:
+            backend = MemoryBackend(app.config["FLASKY_RATELIMIT_SIZE"])
+        elif isinstance(backend, str):
+            backend = import_string(backend)()
+        app.extensions["rate_limit_backend"] = backend
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    @staticmethod
+    def client_key():
+        auth = request.authorization
+        if auth and auth.username and not auth.password:
+            from .models import User
+            user_id = User.auth_token_user_id(auth.username)
+            if user_id is not None:
+                return "user:%d" % user_id
+        return "ip:" + (request.remote_addr or "")
+
+    @staticmethod
+    def endpoint_class():
+        return "read" if request.method in ("GET", "HEAD", "OPTIONS") else "write"
+
+    def before_request(self):
+        return self.limit(self.endpoint_class())
+
+    # 从当前客户端的 kind（"read" 或 "write"）桶中取出 cost 个令牌，配额不足时返回 429 响应。
+    # 批量请求等一次执行多个操作的视图可以直接调用，按实际的操作数计费。
+    def limit(self, kind, cost=1):
+        config = current_app.config
+        if not config["FLASKY_RATELIMIT"] or \
+                request.blueprint not in config["FLASKY_RATELIMIT_BLUEPRINTS"]:
+            return None
+        capacity, period = config["FLASKY_RATELIMIT_" + kind.upper()]
+        allowed, remaining, refill = current_app.extensions["rate_limit_backend"].consume(
+            "%s:%s" % (kind, self.client_key()), capacity, period, cost)
+        g.rate_limit = (capacity, remaining, refill)
+        if allowed:
+            return None
+        response = jsonify({"error": "too many requests",
+                            "message": "Rate limit exceeded, retry later"})
+        response.status_code = 429
+        # 攒够 cost 个令牌所需的时间。
+        response.headers["Retry-After"] = str(int(math.ceil((cost - remaining) * period / capacity)))
+        return response
+
+    def after_request(self, response):
+        limit = g.get("rate_limit")
+        if limit is not None:
+            capacity, remaining, refill = limit
+            response.headers["X-RateLimit-Limit"] = str(capacity)
+            response.headers["X-RateLimit-Remaining"] = str(int(remaining))
+            response.headers["X-RateLimit-Reset"] = str(int(math.ceil(refill)))
+        return response
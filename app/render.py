@@ -0,0 +1,119 @@
+import hashlib
+from threading import local
+from flask import current_app
+from markdown import markdown
+from bleach.sanitizer import Cleaner
+from bleach.linkifier import Linker
+from sqlalchemy.exc import SQLAlchemyError
+from .cache import app_cache
+from .page_cache import mark_pages_stale
+
+# 渲染方式（Markdown 扩展、输出格式等）改变时递增，使旧的缓存全部失效。
+RENDER_VERSION = "1"
+
+# Cleaner 和 Linker 内部持有 HTML 解析器，不能在线程间共享，因此每个线程各建一份，
+# 并按允许的标签集合复用，不必每次渲染都重新构造。
+_local = local()
+
+
+def _cleaner(tags):
+    cleaners = getattr(_local, "cleaners", None)
+    if cleaners is None:
+        cleaners = _local.cleaners = {}
+    cleaner = cleaners.get(tags)
+    if cleaner is None:
+        cleaner = cleaners[tags] = Cleaner(tags=list(tags), strip=True)
+    return cleaner
+
+
+def _linker():
+    linker = getattr(_local, "linker", None)
+    if linker is None:
+        linker = _local.linker = Linker()
+    return linker
+
+
+def render_key(value, tags):
+    data = "\0".join([RENDER_VERSION, ",".join(tags), value])
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def render_html(value, tags):
+    return _linker().linkify(_cleaner(tags).clean(markdown(value, output_format="html")))
+
+
+# 把 Markdown 文本渲染成净化过的 HTML。
+# 结果按 (正文, 允许的标签集合) 的哈希缓存：先查进程内的 LRU，
+# 启用 FLASKY_RENDER_CACHE_PERSIST 时再查 rendered_html 表，都未命中才真正渲染。
+def render_markdown(value, allowed_tags):
+    if value is None:
+        return None
+    tags = tuple(sorted(allowed_tags))
+    key = render_key(value, tags)
+    cache = app_cache("render", maxsize=current_app.config["FLASKY_RENDER_CACHE_SIZE"])
+    html = cache.get(key)
+    if html is not None:
+        return html
+    persist = current_app.config["FLASKY_RENDER_CACHE_PERSIST"]
+    if persist:
+        html = _load(key)
+    if html is None:
+        html = render_html(value, tags)
+        if persist:
+            _store(key, html)
+    cache.set(key, html)
+    return html
+
+
+# 持久化缓存使用独立的连接读写，不影响调用方会话中的事务；
+# 写入失败（例如其他进程已经写入了同一个键）时直接忽略，缓存只是优化。
+def _load(key):
+    from .models import RenderedHTML, db
+    table = RenderedHTML.__table__
+    try:
+        return db.engine.scalar(db.select([table.c.html]).where(table.c.hash == key))
+    except SQLAlchemyError:
+        return None
+
+
+def _store(key, html):
+    from .models import RenderedHTML, db
+    try:
+        db.engine.execute(RenderedHTML.__table__.insert(), hash=key, html=html)
+    except SQLAlchemyError:
+        pass
+
+
+# 按 id 顺序分块读取 model 的所有记录，重新渲染 body_html 并批量写回。
+# 渲染在 executor（通常是进程池）中并行执行；每写完一块就 yield (本块最后一个 id, 本块行数)，
+# 调用方可以据此保存断点，下次从 after_id 之后继续。
+# 批量 UPDATE 绕过了 ORM，因此要自己递增行版本号，使 API 的 ETag 随之变化。
+def rerender(model, after_id=0, since=None, chunk_size=500, executor=None):
+    from .models import db
+    table = model.__table__
+    tags = tuple(sorted(model.allowed_tags))
+    update = table.update().\
+        where(table.c.id == db.bindparam("_id")).\
+        values(body_html=db.bindparam("_body_html"), version=table.c.version + 1)
+    while True:
+        query = db.select([table.c.id, table.c.body]).\
+            where(table.c.id > after_id).\
+            where(table.c.body != None).\
+            order_by(table.c.id).limit(chunk_size)
+        if since is not None:
+            query = query.where(table.c.timestamp >= since)
+        rows = db.session.execute(query).fetchall()
+        if not rows:
+            break
+        bodies = [row.body for row in rows]
+        if executor is not None:
+            htmls = executor.map(render_html, bodies, [tags] * len(bodies),
+                                 chunksize=max(1, len(bodies) // 32))
+        else:
+            htmls = [render_html(body, tags) for body in bodies]
+        db.session.execute(update, [{"_id": row.id, "_body_html": html}
+                                    for row, html in zip(rows, htmls)])
+        mark_pages_stale(db.session)
+        db.session.commit()
+        after_id = rows[-1].id
+        yield after_id, len(rows)
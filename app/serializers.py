@@ -0,0 +1,66 @@
+from operator import attrgetter
+from flask import url_for, g
+
+# 生成 URL 模板时代替 id 的占位值，生成的地址中只会在 id 的位置出现这串数字。
+_URL_PLACEHOLDER = 987654321
+
+
+# 把 url_for(endpoint, id=..., _external=True) 拆成 (前缀, 后缀)，每个请求每个端点只构建一次。
+# 协议和主机名来自当前请求，因此模板只缓存在 g 中，不能跨请求复用。
+def url_template(endpoint):
+    templates = g.setdefault("_url_templates", {})
+    template = templates.get(endpoint)
+    if template is None:
+        url = url_for(endpoint, id=_URL_PLACEHOLDER, _external=True)
+        template = templates[endpoint] = tuple(url.rsplit(str(_URL_PLACEHOLDER), 1))
+    return template
+
+
+# 模型的 json_fields 由以下字段描述组成。
+# datetime 等值原样输出，由 API 的 JSON 编码器（app/json_encoder.py）统一编码为 ISO 8601。
+# get() 是逐个对象求值的通用实现，供 to_json() 使用；
+# compile() 返回在当前请求中可以反复调用的取值函数，供 compiled_serializer() 使用。
+class Field:
+    def __init__(self, attr):
+        self.attr = attr
+
+    def get(self, obj):
+        return getattr(obj, self.attr)
+
+    def compile(self):
+        return attrgetter(self.attr)
+
+
+class URLField(Field):
+    def __init__(self, endpoint, attr="id"):
+        super(URLField, self).__init__(attr)
+        self.endpoint = endpoint
+
+    def get(self, obj):
+        return url_for(self.endpoint, id=getattr(obj, self.attr), _external=True)
+
+    def compile(self):
+        prefix, suffix = url_template(self.endpoint)
+        get = attrgetter(self.attr)
+        return lambda obj: prefix + str(get(obj)) + suffix
+
+
+# 按 json_fields 序列化对象；fields 为 None 时输出全部字段，否则只计算其中列出的字段。
+def select_fields(obj, json_fields, fields=None):
+    if fields is None:
+        return dict((name, field.get(obj)) for name, field in json_fields.items())
+    return dict((name, json_fields[name].get(obj)) for name in fields)
+
+
+# 返回 model 的序列化函数，输出与 to_json(fields) 经 JSON 编码后的结果逐字节相同。
+# 编译结果按 (模型, 字段) 缓存在当前请求中，一页数据里的所有对象共用同一组 URL 模板和取值函数。
+def compiled_serializer(model, fields=None):
+    serializers = g.setdefault("_serializers", {})
+    key = (model, tuple(fields) if fields is not None else None)
+    serializer = serializers.get(key)
+    if serializer is None:
+        names = fields if fields is not None else list(model.json_fields)
+        getters = [(name, model.json_fields[name].compile()) for name in names]
+        serializer = serializers[key] = \
+            lambda obj: {name: get(obj) for name, get in getters}
+    return serializer
@@ -23,6 +23,76 @@ class Config:
     FLASKY_FOLLOWERS_PER_PAGE = 50
     FLASKY_COMMENTS_PER_PAGE = 30
     FLASKY_SLOW_DB_QUERY_TIME = 0.5
+    # 物化时间线：每个用户最多保留的条目数；
+    # 关注者超过 FANOUT_LIMIT 的作者不再写扩散，改为读取时拉取。
+    FLASKY_TIMELINE_MAX_ENTRIES = 1000
+    FLASKY_TIMELINE_FANOUT_LIMIT = 5000
+    # 分页总数的缓存时间（秒）。缓存期内返回的总数是近似值。
+    FLASKY_COUNT_CACHE_TTL = 60
+    FLASKY_COUNT_CACHE_SIZE = 1024
+    # 进程内关注关系索引：增量刷新间隔和全量重建间隔（秒）。
+    FLASKY_FOLLOW_GRAPH_INDEX = False
+    FLASKY_FOLLOW_GRAPH_REFRESH = 5
+    FLASKY_FOLLOW_GRAPH_REBUILD = 600
+    # 关注推荐：每个用户保留的条数，以及近期发文活跃度的统计天数和权重。
+    FLASKY_SUGGESTIONS_PER_USER = 20
+    FLASKY_SUGGESTION_ACTIVITY_DAYS = 30
+    FLASKY_SUGGESTION_ACTIVITY_WEIGHT = 0.5
+    # Markdown 渲染缓存：进程内 LRU 的条目数，以及是否同时写入 rendered_html 表。
+    FLASKY_RENDER_CACHE_SIZE = 4096
+    FLASKY_RENDER_CACHE_PERSIST = False
+    # 已验证 API 令牌的进程内缓存（秒）。
+    FLASKY_TOKEN_CACHE_TTL = 30
+    FLASKY_TOKEN_CACHE_SIZE = 4096
+    # HTTP Basic 认证成功结果的缓存（秒）。
+    FLASKY_CREDENTIAL_CACHE_TTL = 60
+    FLASKY_CREDENTIAL_CACHE_SIZE = 4096
+    # last_seen 的最小刷新间隔和批量写回间隔（秒）。
+    FLASKY_LAST_SEEN_MIN_INTERVAL = 60
+    FLASKY_LAST_SEEN_FLUSH_INTERVAL = 10
+    # 角色表缓存时间（秒）。
+    FLASKY_ROLE_CACHE_TTL = 300
+    # 登录用户的进程内缓存（秒），0 表示不缓存。
+    FLASKY_USER_CACHE_TTL = 0
+    FLASKY_USER_CACHE_SIZE = 4096
+    # 响应压缩：压缩级别（gzip/deflate 为 1-9，brotli 为 0-11）、最小压缩长度（字节）、
+    # 需要压缩的 MIME 类型，以及不压缩的蓝本名称。
+    FLASKY_COMPRESS = True
+    FLASKY_COMPRESS_LEVEL = 6
+    FLASKY_COMPRESS_BROTLI_QUALITY = 4
+    FLASKY_COMPRESS_MIN_SIZE = 500
+    FLASKY_COMPRESS_MIMETYPES = ["text/html", "text/css", "text/plain", "text/xml",
+                                 "application/json", "application/javascript",
+                                 "application/x-ndjson"]
+    FLASKY_COMPRESS_EXCLUDE_BLUEPRINTS = []
+    # 流式响应压缩时，累计多少字节输入或间隔多少秒同步刷新一次。
+    FLASKY_COMPRESS_STREAM_BUFFER = 8192
+    FLASKY_COMPRESS_STREAM_INTERVAL = 1.0
+    # NDJSON 导出每批从数据库读取的行数。
+    FLASKY_EXPORT_BATCH_SIZE = 500
+    # 批量创建接口每个请求最多接受的条目数。
+    FLASKY_BULK_MAX_ITEMS = 500
+    # API 的 JSON 编码器："auto"（安装了 orjson 时使用它）、"orjson" 或 "stdlib"。
+    FLASKY_JSON_ENCODER = "auto"
+    # 批量请求接口每批最多包含的子请求数，以及并发执行时的线程数（1 表示依次执行）。
+    FLASKY_BATCH_MAX_REQUESTS = 20
+    FLASKY_BATCH_WORKERS = 4
+    # API 限流：读/写请求的令牌桶容量和补满所需的秒数，进程内最多跟踪的客户端数，
+    # 以及共享存储的实现（例如 "myapp.limits:RedisBackend"，None 表示只保存在进程内）。
+    FLASKY_RATELIMIT = True
+    FLASKY_RATELIMIT_BLUEPRINTS = ["api"]
+    FLASKY_RATELIMIT_READ = (300, 60)
+    FLASKY_RATELIMIT_WRITE = (60, 60)
+    FLASKY_RATELIMIT_SIZE = 10000
+    FLASKY_RATELIMIT_BACKEND = None
+    # 匿名用户整页缓存：有效期、过期后仍可返回旧页面的时间（秒）和最多缓存的页面数。
+    # 有效期为 0 表示不缓存。
+    FLASKY_PAGE_CACHE_TTL = 30
+    FLASKY_PAGE_CACHE_STALE = 30
+    FLASKY_PAGE_CACHE_SIZE = 1024
+    # 模板片段缓存（{% cache %} 块）：默认有效期（秒）和最多缓存的片段数，有效期为 0 表示不缓存。
+    FLASKY_FRAGMENT_CACHE_TTL = 300
+    FLASKY_FRAGMENT_CACHE_SIZE = 4096
 
     @staticmethod
     def init_app(app):
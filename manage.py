@@ -2,7 +2,7 @@ import os
 from flask_script import Manager, Shell
 from flask_migrate import Migrate, MigrateCommand
 from app import create_app, db
-from app.models import Permission, User, Role, Post, Follow, Comment
+from app.models import Permission, User, Role, Post, Follow, Comment, TimelineEntry, Suggestion
 
 COV = None
 if os.environ.get("FLASK_COVERAGE"):
@@ -21,7 +21,7 @@ migrate = Migrate(app, db)
 
 def make_shell_context():
     return dict(app=app, db=db, User=User, Role=Role, Post=Post, Follow=Follow,
-                Permission=Permission, Comment=Comment)
+                Permission=Permission, Comment=Comment, TimelineEntry=TimelineEntry)
 
 manager.add_command("shell", Shell(make_context=make_shell_context))
 manager.add_command("db", MigrateCommand)
@@ -79,5 +79,144 @@ def deploy():
     # create self-follows for all users
     User.add_self_follows()
 
+@manager.command
+def recount():
+    """Recount the denormalized post, comment and follow counters."""
+    User.recount()
+    Post.recount()
+
+
+@manager.command
+def suggestions(top=None):
+    """Precompute who-to-follow suggestions for every user."""
+    count = Suggestion.generate(int(top) if top is not None else None)
+    print("%d suggestions generated." % count)
+
+
+# 参数名的首字母有重复（chunk/checkpoint），@manager.command 自动生成的短选项会冲突，因此显式声明。
+@manager.option("-s", "--since", dest="since", default=None)
+@manager.option("-n", "--chunk", dest="chunk", default=500)
+@manager.option("-w", "--workers", dest="workers", default=None)
+@manager.option("-r", "--resume", dest="resume", action="store_true", default=False)
+@manager.option("-c", "--checkpoint", dest="checkpoint", default=None)
+def rerender(since=None, chunk=500, workers=None, resume=False, checkpoint=None):
+    """Regenerate body_html for all posts and comments."""
+    import json
+    import time
+    from datetime import datetime
+    from concurrent.futures import ProcessPoolExecutor
+    from app.render import rerender as rerender_model
+
+    if checkpoint is None:
+        checkpoint = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                                  "tmp/rerender.json")
+    if since is not None:
+        since = datetime.strptime(since, "%Y-%m-%d")
+    # 断点文件记录每个模型已经处理到的最大 id，--resume 时从这里继续。
+    done = {}
+    if resume and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            done = json.load(f)
+    executor = ProcessPoolExecutor(int(workers) if workers else None)
+    try:
+        for model in (Post, Comment):
+            name = model.__tablename__
+            total = 0
+            start = time.time()
+            for last_id, count in rerender_model(model, after_id=done.get(name, 0), since=since,
+                                                 chunk_size=int(chunk), executor=executor):
+                total += count
+                done[name] = last_id
+                with open(checkpoint, "w") as f:
+                    json.dump(done, f)
+                elapsed = time.time() - start
+                print("%s: %d rows, up to id %d (%.1f rows/sec)"
+                      % (name, total, last_id, total / elapsed if elapsed else 0))
+            elapsed = time.time() - start
+            print("%s: done, %d rows in %.1fs (%.1f rows/sec)"
+                  % (name, total, elapsed, total / elapsed if elapsed else 0))
+    finally:
+        executor.shutdown()
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+
+@manager.command
+def bench_serializers(rounds=200):
+    """Compare to_json() with the compiled API serializers."""
+    import timeit
+    from flask import json
+    from app.serializers import compiled_serializer
+
+    rounds = int(rounds)
+    for model, per_page in ((Post, app.config["FLASKY_POSTS_PER_PAGE"]),
+                            (Comment, app.config["FLASKY_COMMENTS_PER_PAGE"]),
+                            (User, app.config["FLASKY_FOLLOWERS_PER_PAGE"])):
+        items = model.query.limit(per_page).all()
+        if not items:
+            print("%s: no rows, skipped" % model.__tablename__)
+            continue
+        # 每一轮模拟一个新请求：编译后的序列化函数和 URL 模板都按请求缓存，需要重新构建。
+        with app.test_request_context("/api/v1.0/"):
+            expected = json.dumps([item.to_json() for item in items])
+            actual = json.dumps(list(map(compiled_serializer(model), items)))
+            if actual != expected:
+                raise SystemExit("%s: compiled output differs from to_json()"
+                                 % model.__tablename__)
+
+        def run_to_json():
+            with app.test_request_context("/api/v1.0/"):
+                json.dumps([item.to_json() for item in items])
+
+        def run_compiled():
+            with app.test_request_context("/api/v1.0/"):
+                json.dumps(list(map(compiled_serializer(model), items)))
+
+        before = timeit.timeit(run_to_json, number=rounds)
+        after = timeit.timeit(run_compiled, number=rounds)
+        print("%s: %d items, to_json %.2f ms/page, compiled %.2f ms/page (%.1fx), "
+              "output identical"
+              % (model.__tablename__, len(items), before * 1000 / rounds,
+                 after * 1000 / rounds, before / after))
+
+
+@manager.command
+def bench_json(rounds=500):
+    """Compare JSON encoders on real API pages."""
+    import timeit
+    from flask import json
+    from flask.json import JSONEncoder as FlaskJSONEncoder
+    from app.json_encoder import JSONEncoder, orjson
+    from app.serializers import compiled_serializer
+
+    rounds = int(rounds)
+    encoders = [("flask", FlaskJSONEncoder, "stdlib"), ("stdlib", JSONEncoder, "stdlib")]
+    if orjson is not None:
+        encoders.append(("orjson", JSONEncoder, "orjson"))
+    else:
+        print("orjson is not installed, only the stdlib encoders are compared")
+    for model, name, per_page in ((Post, "posts", app.config["FLASKY_POSTS_PER_PAGE"]),
+                                  (Comment, "comments", app.config["FLASKY_COMMENTS_PER_PAGE"])):
+        with app.test_request_context("/api/v1.0/"):
+            items = model.query.order_by(model.timestamp.desc()).limit(per_page).all()
+            page = {name: list(map(compiled_serializer(model), items)),
+                    "prev": None, "next": None, "count": len(items)}
+            # "flask" 是改用 ISO 日期之前 API 所用的 Flask 默认编码器（HTTP 日期格式）。
+            for label, encoder, backend in encoders:
+                app.config["FLASKY_JSON_ENCODER"] = backend
+                # 与 jsonify() 相同，不缩进并使用紧凑的分隔符。
+                options = dict(cls=encoder, separators=(",", ":"))
+                size = len(json.dumps(page, **options).encode("utf-8"))
+                seconds = timeit.timeit(lambda: json.dumps(page, **options), number=rounds)
+                print("%s (%d items), %s: %.3f ms/page, %d bytes"
+                      % (name, len(items), label, seconds * 1000 / rounds, size))
+
+
+@manager.command
+def rebuild_timelines():
+    """Rebuild the materialized timelines from the follows table."""
+    TimelineEntry.rebuild()
+
+
 if __name__ == "__main__":
     manager.run()
@@ -0,0 +1,40 @@
+"""add denormalized counters.
+
+Revision ID: 5d2e8b7c4a10
+Revises: 1c7f3e9a2b4d
+Create Date: 2026-10-18 10:03:27.904115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2e8b7c4a10'
+down_revision = '1c7f3e9a2b4d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('post_count', sa.Integer(), nullable=True, server_default='0'))
+    op.add_column('users', sa.Column('follower_count', sa.Integer(), nullable=True, server_default='0'))
+    op.add_column('users', sa.Column('followed_count', sa.Integer(), nullable=True, server_default='0'))
+    op.add_column('users', sa.Column('comment_count', sa.Integer(), nullable=True, server_default='0'))
+    op.add_column('posts', sa.Column('comment_count', sa.Integer(), nullable=True, server_default='0'))
+    # 用已有数据填充计数
+    op.execute("UPDATE users SET "
+               "post_count = (SELECT count(*) FROM posts WHERE posts.author_id = users.id), "
+               "follower_count = (SELECT count(*) FROM follows WHERE follows.followed_id = users.id), "
+               "followed_count = (SELECT count(*) FROM follows WHERE follows.follower_id = users.id), "
+               "comment_count = (SELECT count(*) FROM comments WHERE comments.author_id = users.id)")
+    op.execute("UPDATE posts SET "
+               "comment_count = (SELECT count(*) FROM comments WHERE comments.post_id = posts.id)")
+
+
+def downgrade():
+    op.drop_column('posts', 'comment_count')
+    op.drop_column('users', 'comment_count')
+    op.drop_column('users', 'followed_count')
+    op.drop_column('users', 'follower_count')
+    op.drop_column('users', 'post_count')
@@ -1,9 +1,15 @@
 import unittest
 import json
+from unittest import mock
 from base64 import b64encode
-from flask import url_for
+from datetime import datetime
+from flask import url_for, json as flask_json
+from flask_sqlalchemy import get_debug_queries
 from app import create_app, db
-from app.models import Role, User
+from app.cache import cache_stats
+from app.models import Role, User, Post, Comment, Permission
+from app.serializers import compiled_serializer
+from app.json_encoder import orjson
 
 
 class APITestCase(unittest.TestCase):
@@ -84,3 +90,476 @@ class APITestCase(unittest.TestCase):
         self.assertIsNotNone(json_resp.get("posts"))
         self.assertTrue(json_resp.get("count", 0) == 1)
         self.assertTrue(json_resp["posts"][0] == json_post)
+
+    def test_cursor_pagination(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com",
+                 password="cat",
+                 confirmed=True,
+                 role=r)
+        db.session.add(u)
+        db.session.commit()
+        for i in range(5):
+            db.session.add(Post(body="post %d" % i, author=u))
+        db.session.commit()
+        self.app.config["FLASKY_POSTS_PER_PAGE"] = 2
+
+        # walk all pages with the cursor
+        bodies = []
+        url = url_for("api.get_posts", cursor="")
+        while url:
+            resp = self.client.get(url,
+                                   headers=self.get_api_headers("john@example.com", "cat"))
+            self.assertTrue(resp.status_code == 200)
+            json_resp = json.loads(resp.data.decode("utf-8"))
+            self.assertIsNone(json_resp["count"])
+            bodies.extend(post["body"] for post in json_resp["posts"])
+            url = json_resp["next"]
+        self.assertTrue(bodies == ["post %d" % i for i in reversed(range(5))])
+
+        # old clients still get page numbers and a count
+        resp = self.client.get(url_for("api.get_user_posts", id=u.id, page=2),
+                               headers=self.get_api_headers("john@example.com", "cat"))
+        json_resp = json.loads(resp.data.decode("utf-8"))
+        self.assertTrue(json_resp["count"] == 5)
+        self.assertIsNotNone(json_resp["prev"])
+
+        # a malformed cursor is a bad request
+        resp = self.client.get(url_for("api.get_posts", cursor="not-a-cursor"),
+                               headers=self.get_api_headers("john@example.com", "cat"))
+        self.assertTrue(resp.status_code == 400)
+
+    def test_cached_count(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com",
+                 password="cat",
+                 confirmed=True,
+                 role=r)
+        db.session.add(u)
+        for i in range(3):
+            db.session.add(Post(body="post %d" % i, author=u))
+        db.session.commit()
+        self.app.config["FLASKY_POSTS_PER_PAGE"] = 2
+
+        # the first page runs COUNT(*), the next request reuses it
+        resp = self.client.get(url_for("api.get_posts"),
+                               headers=self.get_api_headers("john@example.com", "cat"))
+        json_resp = json.loads(resp.data.decode("utf-8"))
+        self.assertTrue(json_resp["count"] == 3)
+        self.assertFalse(json_resp["count_approximate"])
+        db.session.add(Post(body="post 3", author=u))
+        db.session.commit()
+        resp = self.client.get(url_for("api.get_posts"),
+                               headers=self.get_api_headers("john@example.com", "cat"))
+        json_resp = json.loads(resp.data.decode("utf-8"))
+        self.assertTrue(json_resp["count"] == 3)
+        self.assertTrue(json_resp["count_approximate"])
+
+        # the last page knows the exact total without counting
+        resp = self.client.get(url_for("api.get_posts", page=2),
+                               headers=self.get_api_headers("john@example.com", "cat"))
+        json_resp = json.loads(resp.data.decode("utf-8"))
+        self.assertTrue(json_resp["count"] == 4)
+        self.assertFalse(json_resp["count_approximate"])
+
+    def test_token_auth(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com",
+                 password="cat",
+                 confirmed=True,
+                 role=r)
+        db.session.add(u)
+        db.session.commit()
+
+        # get a token
+        resp = self.client.get(url_for("api.get_token"),
+                               headers=self.get_api_headers("john@example.com", "cat"))
+        self.assertTrue(resp.status_code == 200)
+        token = json.loads(resp.data.decode("utf-8"))["token"]
+
+        # write a post with the token; the first request checks the revocation epoch
+        resp = self.client.post(url_for("api.new_post"),
+                                headers=self.get_api_headers(token, ""),
+                                data=json.dumps({"body": "body of the post"}))
+        self.assertTrue(resp.status_code == 201)
+
+        # afterwards the token is authorized without loading the user or role
+        before = len(get_debug_queries())
+        resp = self.client.get(url_for("api.get_posts", cursor=""),
+                               headers=self.get_api_headers(token, ""))
+        self.assertTrue(resp.status_code == 200)
+        statements = [q.statement for q in get_debug_queries()[before:]]
+        self.assertFalse(any("FROM users" in s or "FROM roles" in s for s in statements))
+
+        # a token cannot be used to request a new token
+        resp = self.client.get(url_for("api.get_token"),
+                               headers=self.get_api_headers(token, ""))
+        self.assertTrue(resp.status_code == 401)
+
+        # changes to the role's permissions apply to outstanding tokens
+        r.permissions = Permission.FOLLOW | Permission.COMMENT
+        db.session.add(r)
+        db.session.commit()
+        resp = self.client.post(url_for("api.new_post"),
+                                headers=self.get_api_headers(token, ""),
+                                data=json.dumps({"body": "another post"}))
+        self.assertTrue(resp.status_code == 403)
+
+        # changing the password revokes the token
+        u.password = "dog"
+        db.session.add(u)
+        db.session.commit()
+        resp = self.client.get(url_for("api.get_posts"),
+                               headers=self.get_api_headers(token, ""))
+        self.assertTrue(resp.status_code == 401)
+
+    def test_credential_cache(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com",
+                 password="cat",
+                 confirmed=True,
+                 role=r)
+        db.session.add(u)
+        db.session.commit()
+        for i in range(3):
+            resp = self.client.get(url_for("api.get_posts"),
+                                   headers=self.get_api_headers("john@example.com", "cat"))
+            self.assertTrue(resp.status_code == 200)
+        stats = cache_stats()["credentials"]
+        self.assertTrue(stats["hits"] == 2 and stats["misses"] == 1)
+
+        # a wrong password is never cached
+        resp = self.client.get(url_for("api.get_posts"),
+                               headers=self.get_api_headers("john@example.com", "dog"))
+        self.assertTrue(resp.status_code == 401)
+
+        # changing the password invalidates the cached verification
+        u.password = "dog"
+        db.session.add(u)
+        db.session.commit()
+        resp = self.client.get(url_for("api.get_posts"),
+                               headers=self.get_api_headers("john@example.com", "cat"))
+        self.assertTrue(resp.status_code == 401)
+        resp = self.client.get(url_for("api.get_posts"),
+                               headers=self.get_api_headers("john@example.com", "dog"))
+        self.assertTrue(resp.status_code == 200)
+
+    def test_conditional_get(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com", password="cat", confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        headers = self.get_api_headers("john@example.com", "cat")
+        resp = self.client.post(url_for("api.new_post"), headers=headers,
+                                data=json.dumps({"body": "first"}))
+        self.assertTrue(resp.status_code == 201)
+        url = resp.headers.get("Location")
+
+        # 单篇文章：ETag 相同时返回 304，编辑后 ETag 改变
+        resp = self.client.get(url, headers=headers)
+        self.assertTrue(resp.status_code == 200)
+        etag = resp.headers.get("ETag")
+        self.assertIsNotNone(etag)
+        self.assertIsNone(resp.headers.get("Last-Modified"))
+        resp = self.client.get(url, headers=dict(headers, **{"If-None-Match": etag}))
+        self.assertTrue(resp.status_code == 304)
+        self.assertTrue(resp.data == b"")
+        since = {"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"}
+        collection = self.client.get(url_for("api.get_posts"), headers=headers)
+        self.assertIsNone(collection.headers.get("Last-Modified"))
+        resp = self.client.put(url, headers=headers, data=json.dumps({"body": "edited"}))
+        self.assertTrue(resp.status_code == 200)
+        resp = self.client.get(url, headers=dict(headers, **{"If-None-Match": etag}))
+        self.assertTrue(resp.status_code == 200)
+        self.assertTrue(resp.headers.get("ETag") != etag)
+
+        # If-Modified-Since cannot detect edits, so it never produces a stale 304
+        resp = self.client.get(url, headers=dict(headers, **since))
+        self.assertTrue(resp.status_code == 200)
+        self.assertTrue(json.loads(resp.get_data(as_text=True))["body"] == "edited")
+        resp = self.client.get(url_for("api.get_posts"), headers=dict(headers, **since))
+        self.assertTrue(resp.status_code == 200)
+        self.assertTrue(json.loads(resp.get_data(as_text=True))["posts"][0]["body"] == "edited")
+
+        # 集合：新增文章或评论后 ETag 改变
+        resp = self.client.get(url_for("api.get_posts"), headers=headers)
+        etag = resp.headers.get("ETag")
+        resp = self.client.get(url_for("api.get_posts"),
+                               headers=dict(headers, **{"If-None-Match": etag}))
+        self.assertTrue(resp.status_code == 304)
+        resp = self.client.get(url_for("api.get_posts", page=2),
+                               headers=dict(headers, **{"If-None-Match": etag}))
+        self.assertTrue(resp.status_code == 200)
+        resp = self.client.post(url_for("api.new_post_comment", id=1), headers=headers,
+                                data=json.dumps({"body": "a comment"}))
+        self.assertTrue(resp.status_code == 201)
+        resp = self.client.get(url_for("api.get_posts"),
+                               headers=dict(headers, **{"If-None-Match": etag}))
+        self.assertTrue(resp.status_code == 200)
+
+    def test_export(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com", password="cat", confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        for i in range(5):
+            db.session.add(Post(body="post %d" % i, author=u,
+                                timestamp=datetime(2026, 1, i + 1)))
+        db.session.commit()
+        self.app.config["FLASKY_EXPORT_BATCH_SIZE"] = 2
+        headers = self.get_api_headers("john@example.com", "cat")
+
+        resp = self.client.get(url_for("api.export_posts"), headers=headers)
+        self.assertTrue(resp.status_code == 200)
+        self.assertTrue(resp.mimetype == "application/x-ndjson")
+        lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertTrue([line["body"] for line in lines] == ["post %d" % i for i in range(5)])
+
+        # resume after the last id received, and filter by timestamp
+        resp = self.client.get(url_for("api.export_posts", after=lines[2]["id"]), headers=headers)
+        lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertTrue([line["body"] for line in lines] == ["post 3", "post 4"])
+        resp = self.client.get(url_for("api.export_posts", since="2026-01-02",
+                                       until="2026-01-04"), headers=headers)
+        lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertTrue([line["body"] for line in lines] == ["post 1", "post 2"])
+        resp = self.client.get(url_for("api.export_posts", since="yesterday"), headers=headers)
+        self.assertTrue(resp.status_code == 400)
+
+        resp = self.client.get(url_for("api.export_users"), headers=headers)
+        self.assertTrue(len(resp.get_data(as_text=True).splitlines()) == 1)
+        resp = self.client.get(url_for("api.export_comments"), headers=headers)
+        self.assertTrue(resp.get_data() == b"")
+
+    def test_bulk_create(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com", password="cat", confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        headers = self.get_api_headers("john@example.com", "cat")
+
+        resp = self.client.post(url_for("api.new_posts"), headers=headers,
+                                data=json.dumps([{"body": "post 1"}, {"body": ""},
+                                                 "not an object", {"body": "post *2*"}]))
+        self.assertTrue(resp.status_code == 200)
+        json_resp = json.loads(resp.data.decode("utf-8"))
+        self.assertTrue(json_resp["created"] == 2)
+        self.assertTrue([result["status"] for result in json_resp["results"]] ==
+                        [201, 400, 400, 201])
+        resp = self.client.get(json_resp["results"][3]["url"], headers=headers)
+        self.assertTrue(json.loads(resp.data.decode("utf-8"))["body_html"] ==
+                        "<p>post <em>2</em></p>")
+
+        # counters and the author's own timeline are maintained
+        db.session.expire_all()
+        self.assertTrue(u.post_count == 2)
+        self.assertTrue(u.followed_posts.count() == 2)
+
+        post = Post.query.first()
+        resp = self.client.post(url_for("api.new_post_comments", id=post.id), headers=headers,
+                                data=json.dumps([{"body": "a"}, {"body": "b"}]))
+        json_resp = json.loads(resp.data.decode("utf-8"))
+        self.assertTrue(json_resp["created"] == 2)
+        db.session.expire_all()
+        self.assertTrue(post.comment_count == 2)
+        self.assertTrue(u.comment_count == 2)
+
+        # oversized batches and non-arrays are rejected as a whole
+        self.app.config["FLASKY_BULK_MAX_ITEMS"] = 1
+        resp = self.client.post(url_for("api.new_posts"), headers=headers,
+                                data=json.dumps([{"body": "x"}, {"body": "y"}]))
+        self.assertTrue(resp.status_code == 400)
+        resp = self.client.post(url_for("api.new_posts"), headers=headers,
+                                data=json.dumps({"body": "x"}))
+        self.assertTrue(resp.status_code == 400)
+
+        # batches created within the same clock tick get only their own ids
+        class FrozenDatetime(datetime):
+            @classmethod
+            def utcnow(cls):
+                return datetime(2026, 1, 1)
+
+        before = len(get_debug_queries())
+        with mock.patch("app.models.datetime", FrozenDatetime):
+            first = Post.bulk_create(u.id, [Post(body="a"), Post(body="b")])
+            second = Post.bulk_create(u.id, [Post(body="c")])
+        db.session.commit()
+        # on SQLite each batch is written with one executemany INSERT
+        inserts = [q for q in get_debug_queries()[before:]
+                   if q.statement.startswith("INSERT INTO posts")]
+        self.assertTrue(len(inserts) == 2)
+        self.assertTrue(len(first) == 2 and len(second) == 1)
+        self.assertTrue([Post.query.get(id).body for id in first + second] == ["a", "b", "c"])
+        db.session.expire_all()
+        self.assertTrue(u.post_count == 5)
+
+    def test_sparse_fields(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com", password="cat", confirmed=True, role=r)
+        db.session.add(u)
+        db.session.add(Post(body="body", author=u))
+        db.session.commit()
+        headers = self.get_api_headers("john@example.com", "cat")
+
+        resp = self.client.get(url_for("api.get_posts", fields="body,timestamp"),
+                               headers=headers)
+        json_resp = json.loads(resp.data.decode("utf-8"))
+        self.assertTrue(sorted(json_resp["posts"][0].keys()) == ["body", "timestamp"])
+        resp = self.client.get(url_for("api.get_user", id=u.id, fields="username"),
+                               headers=headers)
+        self.assertTrue(list(json.loads(resp.data.decode("utf-8")).keys()) == ["username"])
+        resp = self.client.get(url_for("api.get_posts"), headers=headers)
+        json_resp = json.loads(resp.data.decode("utf-8"))
+        self.assertTrue(set(json_resp["posts"][0].keys()) == set(Post.json_fields))
+
+        resp = self.client.get(url_for("api.get_posts", fields="body,password_hash"),
+                               headers=headers)
+        self.assertTrue(resp.status_code == 400)
+
+    def test_compiled_serializers(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com", username="john", password="cat", role=r)
+        db.session.add(u)
+        db.session.commit()
+        post = Post(body="*body*", author=u, timestamp=datetime(2026, 2, 3, 4, 5, 6, 789))
+        db.session.add(post)
+        db.session.add(Comment(body="comment", author=u, post=post))
+        db.session.commit()
+        for model in (User, Post, Comment):
+            for fields in (None, ["url", "timestamp"] if model is not User else ["url"]):
+                # compiled output must encode to exactly the same bytes as to_json()
+                with self.app.test_request_context("/", base_url="https://example.com:8443"):
+                    for obj in model.query.all():
+                        self.assertTrue(
+                            flask_json.dumps(obj.to_json(fields)) ==
+                            flask_json.dumps(compiled_serializer(model, fields)(obj)))
+
+    def test_json_encoder(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com", password="cat", confirmed=True, role=r)
+        db.session.add(u)
+        db.session.add(Post(body="body", author=u, timestamp=datetime(2026, 2, 3, 4, 5, 6, 789)))
+        db.session.commit()
+        headers = self.get_api_headers("john@example.com", "cat")
+
+        self.app.config["FLASKY_JSON_ENCODER"] = "stdlib"
+        resp = self.client.get(url_for("api.get_posts"), headers=headers)
+        json_resp = json.loads(resp.data.decode("utf-8"))
+        self.assertTrue(json_resp["posts"][0]["timestamp"] == "2026-02-03T04:05:06.000789Z")
+        stdlib_data = resp.data
+
+        if orjson is not None:
+            # both encoders produce the same bytes for ASCII content
+            self.app.config["FLASKY_JSON_ENCODER"] = "orjson"
+            resp = self.client.get(url_for("api.get_posts"), headers=headers)
+            self.assertTrue(resp.data == stdlib_data)
+
+    def test_batch(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com", password="cat", confirmed=True, role=r)
+        db.session.add(u)
+        db.session.add(Post(body="body", author=u))
+        db.session.commit()
+        headers = self.get_api_headers("john@example.com", "cat")
+        paths = ["/posts/1", "/users/%d" % u.id, "posts/1/comments/?fields=body",
+                 "/api/v1.0/users/%d/posts/" % u.id, "/posts/999", "/posts/?cursor=bad"]
+
+        for concurrent in (False, True):
+            resp = self.client.post(url_for("api.batch"), headers=headers,
+                                    data=json.dumps({"requests": paths,
+                                                     "concurrent": concurrent}))
+            self.assertTrue(resp.status_code == 200)
+            self.assertIsNone(resp.headers.get("ETag"))
+            responses = json.loads(resp.data.decode("utf-8"))["responses"]
+            self.assertTrue([r["status"] for r in responses] == [200, 200, 200, 200, 404, 400])
+            self.assertTrue(responses[0]["body"]["body"] == "body")
+            self.assertTrue(responses[2]["body"]["comments"] == [])
+            self.assertTrue(len(responses[3]["body"]["posts"]) == 1)
+
+        # the batch is authenticated as a whole
+        resp = self.client.post(url_for("api.batch"),
+                                headers=self.get_api_headers("john@example.com", "dog"),
+                                data=json.dumps({"requests": paths}))
+        self.assertTrue(resp.status_code == 401)
+
+        self.app.config["FLASKY_BATCH_MAX_REQUESTS"] = 2
+        resp = self.client.post(url_for("api.batch"), headers=headers,
+                                data=json.dumps({"requests": paths}))
+        self.assertTrue(resp.status_code == 400)
+
+    def test_rate_limit(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com", password="cat", confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        headers = self.get_api_headers("john@example.com", "cat")
+        self.app.config["FLASKY_RATELIMIT_READ"] = (2, 3600)
+        self.app.config["FLASKY_RATELIMIT_WRITE"] = (1, 3600)
+
+        resp = self.client.get(url_for("api.get_posts"), headers=headers)
+        self.assertTrue(resp.status_code == 200)
+        self.assertTrue(resp.headers.get("X-RateLimit-Limit") == "2")
+        self.assertTrue(resp.headers.get("X-RateLimit-Remaining") == "1")
+        resp = self.client.get(url_for("api.get_posts"), headers=headers)
+        self.assertTrue(resp.status_code == 200)
+
+        # the third read is rejected before authentication touches the database
+        before = len(get_debug_queries())
+        resp = self.client.get(url_for("api.get_posts"), headers=headers)
+        self.assertTrue(resp.status_code == 429)
+        self.assertTrue(resp.headers.get("X-RateLimit-Remaining") == "0")
+        self.assertIsNotNone(resp.headers.get("Retry-After"))
+        self.assertTrue(len(get_debug_queries()) == before)
+
+        # writes have their own bucket, other clients are unaffected
+        resp = self.client.post(url_for("api.new_post"), headers=headers,
+                                data=json.dumps({"body": "body"}))
+        self.assertTrue(resp.status_code == 201)
+        resp = self.client.post(url_for("api.new_post"), headers=headers,
+                                data=json.dumps({"body": "body"}))
+        self.assertTrue(resp.status_code == 429)
+        resp = self.client.get(url_for("api.get_posts"),
+                               headers=self.get_api_headers("susan@example.com", "dog"),
+                               environ_base={"REMOTE_ADDR": "10.0.0.2"})
+        self.assertTrue(resp.status_code == 401)
+
+        # failed logins with john's email from another address do not use up john's quota
+        for i in range(3):
+            self.client.get(url_for("api.get_posts"),
+                            headers=self.get_api_headers("john@example.com", "dog"),
+                            environ_base={"REMOTE_ADDR": "10.0.0.3"})
+        resp = self.client.get(url_for("api.get_posts"), headers=headers,
+                               environ_base={"REMOTE_ADDR": "10.0.0.4"})
+        self.assertTrue(resp.status_code == 200)
+
+    def test_rate_limit_tokens_and_batches(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com", password="cat", confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        self.app.config["FLASKY_RATELIMIT_READ"] = (3, 3600)
+
+        # all tokens of a user share the user's bucket
+        tokens = [u.generate_auth_token(3600 + i) for i in range(3)]
+        self.assertTrue(len(set(tokens)) == 3)
+        for i, token in enumerate(tokens):
+            resp = self.client.get(url_for("api.get_posts"),
+                                   headers=self.get_api_headers(token, ""),
+                                   environ_base={"REMOTE_ADDR": "10.0.0.%d" % i})
+            self.assertTrue(resp.status_code == 200)
+        resp = self.client.get(url_for("api.get_posts"),
+                               headers=self.get_api_headers(tokens[0], ""),
+                               environ_base={"REMOTE_ADDR": "10.0.0.9"})
+        self.assertTrue(resp.status_code == 429)
+
+        # every request in a batch costs one read token
+        headers = self.get_api_headers("john@example.com", "cat")
+        paths = ["/posts/", "/posts/", "/posts/"]
+        resp = self.client.post(url_for("api.batch"), headers=headers,
+                                data=json.dumps({"requests": paths}))
+        self.assertTrue(resp.status_code == 200)
+        resp = self.client.get(url_for("api.get_posts"), headers=headers)
+        self.assertTrue(resp.status_code == 429)
+        resp = self.client.post(url_for("api.batch"), headers=headers,
+                                data=json.dumps({"requests": paths[:1]}))
+        self.assertTrue(resp.status_code == 429)
@@ -1,8 +1,14 @@
 import re
+import time
 import unittest
+import zlib
 from flask import url_for
+from flask_sqlalchemy import get_debug_queries
 from app import create_app, db
-from app.models import Role, User
+from app.compress import Compress, _ZlibCompressor
+from app.cache import cache_stats
+from app.page_cache import page_cache, page_entries
+from app.models import Role, User, Post, Comment
 
 
 class FlaskClientTestCase(unittest.TestCase):
@@ -67,3 +73,147 @@ class FlaskClientTestCase(unittest.TestCase):
                                follow_redirects=True)
         self.assertTrue(b"You have been logged out" in resp.data)
         # self.assertTrue("You have been logged out" in resp.data)
+
+    def test_index_query_count(self):
+        # 每页的查询数量固定，不随文章数量增长。
+        def index_queries():
+            before = len(get_debug_queries())
+            resp = self.client.get(url_for("main.index"))
+            self.assertTrue(resp.status_code == 200)
+            return len(get_debug_queries()) - before
+
+        def add_posts(start, count):
+            for i in range(start, start + count):
+                u = User(email="user%d@example.com" % i, username="user%d" % i,
+                         password="cat")
+                p = Post(body="post %d" % i, author=u)
+                db.session.add_all([u, p, Comment(body="comment", post=p, author=u)])
+            db.session.commit()
+
+        add_posts(0, 2)
+        small_page = index_queries()
+        add_posts(2, 10)
+        self.assertTrue(index_queries() == small_page)
+        self.assertTrue(small_page <= 3)
+
+    def test_compression(self):
+        resp = self.client.get(url_for("main.index"),
+                               headers={"Accept-Encoding": "gzip, deflate"})
+        self.assertTrue(resp.headers.get("Content-Encoding") == "gzip")
+        self.assertTrue("Accept-Encoding" in resp.headers.get("Vary"))
+        html = zlib.decompress(resp.data, zlib.MAX_WBITS | 16).decode("utf-8")
+        self.assertTrue("Strange" in html)
+
+        resp = self.client.get(url_for("main.index"),
+                               headers={"Accept-Encoding": "deflate"})
+        self.assertTrue(resp.headers.get("Content-Encoding") == "deflate")
+        self.assertTrue("Strange" in zlib.decompress(resp.data).decode("utf-8"))
+
+        # 客户端不接受压缩、蓝本被排除时原样返回
+        resp = self.client.get(url_for("main.index"), headers={"Accept-Encoding": "identity"})
+        self.assertIsNone(resp.headers.get("Content-Encoding"))
+        self.app.config["FLASKY_COMPRESS_EXCLUDE_BLUEPRINTS"] = ["main"]
+        resp = self.client.get(url_for("main.index"), headers={"Accept-Encoding": "gzip"})
+        self.assertIsNone(resp.headers.get("Content-Encoding"))
+
+        # 过短的响应不压缩
+        self.app.config["FLASKY_COMPRESS_EXCLUDE_BLUEPRINTS"] = []
+        self.app.config["FLASKY_COMPRESS_MIN_SIZE"] = 10 ** 6
+        resp = self.client.get(url_for("main.index"), headers={"Accept-Encoding": "gzip"})
+        self.assertIsNone(resp.headers.get("Content-Encoding"))
+
+    def test_streamed_compression(self):
+        chunks = [("line %d\n" % i).encode("utf-8") for i in range(2000)]
+        # 缓冲为 1 字节时每块都同步刷新，收到第一块就能解压出对应的内容
+        stream = Compress.stream(_ZlibCompressor("gzip", 6), iter(chunks), 1, 60)
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        self.assertTrue(decompressor.decompress(next(stream)) == chunks[0])
+        data = b"".join(decompressor.decompress(block) for block in stream)
+        self.assertTrue(data == b"".join(chunks[1:]))
+
+        # 按缓冲大小刷新时，压缩率接近一次性压缩整个主体
+        unbuffered = b"".join(Compress.stream(_ZlibCompressor("gzip", 6), iter(chunks), 1, 60))
+        buffered = b"".join(Compress.stream(_ZlibCompressor("gzip", 6), iter(chunks), 8192, 60))
+        whole = zlib.compress(b"".join(chunks), 6)
+        self.assertTrue(zlib.decompress(buffered, zlib.MAX_WBITS | 16) == b"".join(chunks))
+        self.assertTrue(len(buffered) < len(whole) * 1.2)
+        self.assertTrue(len(buffered) * 2 < len(unbuffered))
+
+    def test_page_cache(self):
+        u = User(email="john@example.com", username="john", password="cat", confirmed=True)
+        db.session.add_all([u, Post(body="first post", author=u)])
+        db.session.commit()
+
+        resp = self.client.get(url_for("main.index"))
+        self.assertTrue(resp.headers.get("X-Page-Cache") == "MISS")
+        self.assertTrue("public" in resp.headers.get("Cache-Control"))
+        self.assertTrue("stale-while-revalidate" in resp.headers.get("Cache-Control"))
+        self.assertTrue("Cookie" in resp.headers.get("Vary"))
+        resp = self.client.get(url_for("main.index"))
+        self.assertTrue(resp.headers.get("X-Page-Cache") == "HIT")
+        self.assertTrue(b"first post" in resp.data)
+        # pages are keyed by page number
+        resp = self.client.get(url_for("main.index", page=2))
+        self.assertTrue(resp.headers.get("X-Page-Cache") == "MISS")
+
+        # a committed change invalidates the cached pages
+        db.session.add(Post(body="second post", author=u))
+        db.session.commit()
+        resp = self.client.get(url_for("main.index"))
+        self.assertTrue(resp.headers.get("X-Page-Cache") == "MISS")
+        self.assertTrue(b"second post" in resp.data)
+
+        # while another request regenerates a stale page, the old page is served
+        page_cache().invalidate()
+        key = ("main.index", (), 1)
+        self.assertTrue(page_cache().claim(key))
+        resp = self.client.get(url_for("main.index"))
+        self.assertTrue(resp.headers.get("X-Page-Cache") == "STALE")
+
+        # a page too old to serve stale is regenerated, but another request's claim is kept
+        entries = page_entries()
+        body, mimetype, created, generation = entries.get(key)
+        entries.set(key, (body, mimetype, time.monotonic() - 3600, generation))
+        resp = self.client.get(url_for("main.index"))
+        self.assertTrue(resp.headers.get("X-Page-Cache") == "MISS")
+        self.assertFalse(page_cache().claim(key))
+        page_cache().release(key)
+
+        # logged-in users always get a fresh, private page
+        self.client.post(url_for("auth.login"), data={"email": "john@example.com",
+                                                       "password": "cat"})
+        resp = self.client.get(url_for("main.index"))
+        self.assertIsNone(resp.headers.get("X-Page-Cache"))
+        self.assertTrue("private" in resp.headers.get("Cache-Control"))
+        self.assertTrue(re.search(b"Hello,\\s+john!", resp.data))
+
+    def test_fragment_cache(self):
+        john = User(email="john@example.com", username="john", password="cat", confirmed=True)
+        susan = User(email="susan@example.com", username="susan", password="dog", confirmed=True)
+        post = Post(body="first post", author=john)
+        db.session.add_all([john, susan, post])
+        db.session.commit()
+
+        # the author sees the Edit label, other users share the cached fragment without it
+        self.client.post(url_for("auth.login"), data={"email": "john@example.com",
+                                                       "password": "cat"})
+        resp = self.client.get(url_for("main.post", id=post.id))
+        self.assertTrue(b"first post" in resp.data)
+        self.assertTrue(b"label-primary\">Edit" in resp.data)
+        fragments = cache_stats()["fragments"]
+        self.assertTrue(fragments["size"] == 1 and fragments["misses"] == 1)
+        self.client.get(url_for("auth.logout"))
+        self.client.post(url_for("auth.login"), data={"email": "susan@example.com",
+                                                       "password": "dog"})
+        resp = self.client.get(url_for("main.post", id=post.id))
+        self.assertTrue(b"first post" in resp.data)
+        self.assertFalse(b"Edit" in resp.data)
+        self.assertTrue(cache_stats()["fragments"]["hits"] == 1)
+
+        # updating the post bumps its version, so the old fragment is not used
+        post.body = "edited post"
+        db.session.add(post)
+        db.session.commit()
+        resp = self.client.get(url_for("main.post", id=post.id))
+        self.assertTrue(b"edited post" in resp.data)
+        self.assertFalse(b"first post" in resp.data)
@@ -1,8 +1,21 @@
 import unittest
+import gc
 import time
+import weakref
 from datetime import datetime
 from app import create_app, db
-from app.models import User, Role, Permission, AnonymousUser, Follow
+from app.follow_graph import follow_graph
+from app.cache import cache_stats
+from app.render import rerender
+from app.last_seen import last_seen_buffer
+from flask_sqlalchemy import get_debug_queries
+from app.models import User, Role, Permission, AnonymousUser, Follow, Post, Comment, TimelineEntry, \
+    Suggestion, RenderedHTML, load_user
+try:
+    import numpy
+    import scipy
+except ImportError:
+    numpy = None
 
 
 class UserModelTestCase(unittest.TestCase):
@@ -166,3 +179,284 @@ class UserModelTestCase(unittest.TestCase):
         db.session.delete(u2)
         db.session.commit()
         self.assertTrue(Follow.query.count() == 1)
+
+    def test_timeline(self):
+        u1 = User(email="john@example.com", password="cat")
+        u2 = User(email="susan@example.org", password="dog")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        p1 = Post(body="before follow", author=u2)
+        db.session.add(p1)
+        db.session.commit()
+        self.assertTrue(u1.followed_posts.count() == 0)
+        u1.follow(u2)
+        self.assertTrue(u1.followed_posts.all() == [p1])
+        p2 = Post(body="after follow", author=u2)
+        db.session.add(p2)
+        db.session.commit()
+        self.assertTrue(u1.followed_posts.count() == 2)
+        self.assertTrue(u2.followed_posts.count() == 2)
+        u1.unfollow(u2)
+        self.assertTrue(u1.followed_posts.count() == 0)
+        self.assertTrue(TimelineEntry.query.filter_by(user_id=u1.id).count() == 0)
+
+    def test_timeline_cap_and_pull(self):
+        self.app.config["FLASKY_TIMELINE_MAX_ENTRIES"] = 2
+        self.app.config["FLASKY_TIMELINE_FANOUT_LIMIT"] = 1
+        u1 = User(email="john@example.com", password="cat")
+        u2 = User(email="susan@example.org", password="dog")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        for i in range(3):
+            db.session.add(Post(body="post %d" % i, author=u1,
+                                timestamp=datetime(2017, 1, i + 1)))
+            db.session.commit()
+        self.assertTrue(TimelineEntry.query.filter_by(user_id=u1.id).count() == 2)
+        self.assertTrue(u1.followed_posts.count() == 2)
+        # u1 now has two followers and switches to pull mode
+        u2.follow(u1)
+        p = Post(body="pulled", author=u1)
+        db.session.add(p)
+        db.session.commit()
+        self.assertTrue(u1.timeline_pull)
+        self.assertTrue(p in u2.followed_posts.all())
+        self.assertTrue(u2.followed_posts.count() == 4)
+
+    def test_counters(self):
+        u1 = User(email="john@example.com", password="cat")
+        u2 = User(email="susan@example.org", password="dog")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertTrue(u1.follower_count == 1 and u1.followed_count == 1)
+        u1.follow(u2)
+        self.assertTrue(u1.followed_count == 2)
+        self.assertTrue(u2.follower_count == 2)
+        p = Post(body="post", author=u2)
+        db.session.add(p)
+        db.session.commit()
+        c = Comment(body="comment", post=p, author=u1)
+        db.session.add(c)
+        db.session.commit()
+        self.assertTrue(u2.post_count == 1)
+        self.assertTrue(u1.comment_count == 1)
+        self.assertTrue(p.comment_count == 1)
+        db.session.delete(c)
+        db.session.commit()
+        self.assertTrue(p.comment_count == 0)
+        self.assertTrue(u1.comment_count == 0)
+        u1.unfollow(u2)
+        self.assertTrue(u1.followed_count == 1)
+        self.assertTrue(u2.follower_count == 1)
+
+        # recount repairs drifted counters
+        u2.post_count = 42
+        p.comment_count = 7
+        db.session.commit()
+        User.recount()
+        Post.recount()
+        self.assertTrue(u2.post_count == 1)
+        self.assertTrue(p.comment_count == 0)
+
+    def test_follow_graph(self):
+        self.app.config["FLASKY_FOLLOW_GRAPH_INDEX"] = True
+        u1 = User(email="john@example.com", password="cat")
+        u2 = User(email="susan@example.org", password="dog")
+        u3 = User(email="david@example.net", password="dog")
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        graph = follow_graph()
+        graph.rebuild()
+        self.assertTrue(u1.is_following(u1))
+        self.assertFalse(u1.is_following(u2))
+        u1.follow(u2)
+        self.assertTrue(u1.is_following(u2))
+        self.assertTrue(u2.is_followed_by(u1))
+        self.assertTrue(graph.followers_count(u2.id) == 2)
+        u1.unfollow(u2)
+        self.assertFalse(u1.is_following(u2))
+
+        # follows written elsewhere are picked up incrementally
+        db.session.add(Follow(follower=u3, followed=u1))
+        db.session.commit()
+        self.assertFalse(u3.is_following(u1))
+        graph.refresh()
+        self.assertTrue(u3.is_following(u1))
+        self.assertTrue(graph.following_count(u3.id) == 2)
+
+        # follow() and unfollow() check the database, not a stale index
+        db.session.add(Follow(follower=u2, followed=u3))
+        db.session.commit()
+        self.assertFalse(u2.is_following(u3))
+        self.assertFalse(u2.follow(u3))
+        self.assertTrue(u2.is_following(u3))
+        Follow.query.filter_by(follower_id=u3.id, followed_id=u1.id).delete()
+        db.session.commit()
+        self.assertTrue(u3.is_following(u1))
+        self.assertFalse(u3.unfollow(u1))
+        self.assertFalse(u3.is_following(u1))
+        self.assertTrue(u3.follow(u1))
+        self.assertTrue(u3.is_following(u1))
+
+    @unittest.skipUnless(numpy, "NumPy/SciPy not installed")
+    def test_suggestions(self):
+        u1 = User(email="john@example.com", password="cat")
+        u2 = User(email="susan@example.org", password="dog")
+        u3 = User(email="david@example.net", password="dog")
+        u4 = User(email="mary@example.com", password="dog")
+        db.session.add_all([u1, u2, u3, u4])
+        db.session.commit()
+        u1.follow(u2)
+        u1.follow(u3)
+        u2.follow(u4)
+        u3.follow(u4)
+        u2.follow(u3)
+        self.assertTrue(Suggestion.generate() == 1)
+        suggestions = u1.suggestions()
+        self.assertTrue([s.suggested for s in suggestions] == [u4])
+        self.assertTrue(suggestions[0].mutual_count == 2)
+        u1.follow(u4)
+        self.assertTrue(u1.suggestions() == [])
+
+    def test_render_cache(self):
+        import bleach
+        from markdown import markdown
+        body = "*hello* <script>x</script> see http://example.com"
+        p1 = Post(body=body)
+        expected = bleach.linkify(bleach.clean(
+            markdown(body, output_format="html"),
+            tags=["a", "abbr", "acronym", "b", "blockquote", "code", "em", "i", "li", "ol",
+                  "pre", "strong", "ul", "h1", "h2", "h3", "p"], strip=True))
+        self.assertTrue(p1.body_html == expected)
+        p2 = Post(body=body)
+        self.assertTrue(p2.body_html == expected)
+        self.assertTrue(cache_stats()["render"]["hits"] == 1)
+        # comments allow a different tag set, so they get their own entry
+        c = Comment(body=body)
+        self.assertTrue("<p>" not in c.body_html)
+        self.assertTrue(cache_stats()["render"]["misses"] == 2)
+
+    def test_render_cache_persist(self):
+        self.app.config["FLASKY_RENDER_CACHE_PERSIST"] = True
+        Post(body="*persisted*")
+        self.assertTrue(RenderedHTML.query.count() == 1)
+        self.app.extensions["flasky_caches"]["render"].clear()
+        self.assertTrue(Post(body="*persisted*").body_html == "<p><em>persisted</em></p>")
+        self.assertTrue(RenderedHTML.query.count() == 1)
+
+    def test_rerender(self):
+        for i in range(5):
+            db.session.add(Post(body="*post %d*" % i))
+        db.session.commit()
+        db.session.execute(Post.__table__.update().values(body_html="stale"))
+        db.session.commit()
+        chunks = list(rerender(Post, after_id=1, chunk_size=2))
+        self.assertTrue(chunks == [(3, 2), (5, 2)])
+        self.assertTrue(Post.query.filter_by(body_html="stale").count() == 1)
+        self.assertTrue(Post.query.get(5).body_html == "<p><em>post 4</em></p>")
+
+    def test_ping_write_behind(self):
+        u = User(password="cat")
+        db.session.add(u)
+        db.session.commit()
+        last_seen_before = u.last_seen
+        buffer = last_seen_buffer()
+        buffer.flush_interval = 3600
+        u.ping()
+        u.ping()
+        self.assertFalse(u in db.session.dirty)
+        db.session.expire(u)
+        self.assertTrue(u.last_seen == last_seen_before)
+        self.assertTrue(buffer.flush() == 1)
+        db.session.expire(u)
+        self.assertTrue(u.last_seen > last_seen_before)
+
+        # the exit handler does not keep buffers (and their apps) alive
+        app = create_app("testing")
+        with app.app_context():
+            ref = weakref.ref(last_seen_buffer())
+        del app
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_role_cache(self):
+        u = User(email="john@example.com", password="cat")
+        db.session.add(u)
+        db.session.commit()
+        u = User.query.get(u.id)
+        before = len(get_debug_queries())
+        self.assertTrue(u.can(Permission.WRITE_ARTICLES))
+        self.assertFalse(u.is_administrator())
+        User(email="susan@example.org", password="dog")
+        self.assertTrue(len(get_debug_queries()) == before)
+
+        # editing a role refreshes the cache
+        r = Role.query.filter_by(name="User").first()
+        r.permissions = Permission.FOLLOW
+        db.session.commit()
+        self.assertFalse(u.can(Permission.WRITE_ARTICLES))
+        Role.insert_roles()
+        self.assertTrue(u.can(Permission.WRITE_ARTICLES))
+
+    def test_admin_role(self):
+        u = User(email=self.app.config["FLASKY_ADMIN"], password="cat")
+        self.assertTrue(u.is_administrator())
+
+    def test_row_versions(self):
+        u = User(email="john@example.com", password="cat")
+        p = Post(body="body", author=u)
+        c = Comment(body="comment", author=u, post=p)
+        db.session.add_all([u, p, c])
+        db.session.commit()
+        self.assertTrue(p.version == 1 and c.version == 1)
+        p.body = "edited"
+        db.session.add(p)
+        db.session.commit()
+        self.assertTrue(p.version == 2)
+
+        # a concurrent Core update (e.g. manage.py rerender) does not make the edit fail
+        posts = Post.__table__
+        db.session.execute(posts.update().where(posts.c.id == p.id).
+                           values(version=posts.c.version + 1))
+        p.body = "edited again"
+        c.disabled = True
+        db.session.add_all([p, c])
+        db.session.commit()
+        self.assertTrue(p.version == 4 and c.version == 2)
+
+    def test_load_user_cache(self):
+        self.app.config["FLASKY_USER_CACHE_TTL"] = 30
+        u = User(email="john@example.com", username="john", password="cat")
+        db.session.add(u)
+        db.session.commit()
+        id = u.id
+        db.session.remove()
+        self.assertTrue(load_user(str(id)).username == "john")
+        db.session.remove()
+        before = len(get_debug_queries())
+        u = load_user(str(id))
+        self.assertTrue(len(get_debug_queries()) == before)
+        self.assertTrue(u.username == "john")
+        self.assertTrue(u.can(Permission.FOLLOW))
+
+        # a profile change invalidates the cached identity
+        u.confirmed = True
+        db.session.add(u)
+        db.session.commit()
+        db.session.remove()
+        self.assertTrue(load_user(str(id)).confirmed)
+        self.assertTrue(len(get_debug_queries()) > before)
+
+        # so do counter and last_seen updates written with Core statements
+        db.session.add(Post(body="body", author_id=id))
+        db.session.commit()
+        db.session.remove()
+        self.assertTrue(load_user(str(id)).post_count == 1)
+        Post.bulk_create(id, [Post(body="a"), Post(body="b")])
+        db.session.commit()
+        db.session.remove()
+        self.assertTrue(load_user(str(id)).post_count == 3)
+        db.session.remove()
+        buffer = last_seen_buffer()
+        buffer.add(id, datetime(2030, 1, 1))
+        buffer.flush()
+        self.assertTrue(load_user(str(id)).last_seen == datetime(2030, 1, 1))